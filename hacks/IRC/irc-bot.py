@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
 import base64
-import sys
+from collections import Counter, deque
+import configparser
+import logging
+import os
 from pprint import pformat
-from nullroute.irc import Frame
+import random
+import signal
+import struct
+import sys
+import time
+import tracemalloc
+import types
+import weakref
+from nullroute.irc import Frame, LineBuffer
 
 class SaslMechanism(object):
     def __init__(self):
@@ -78,13 +91,131 @@ def b64chunked(buf):
     if not 0 < len(last) < size:
         yield "+"
 
-def trace(*a):
-    print(*a, file=sys.stderr)
+log = logging.getLogger("irc-bot")
+
+class Pretty(object):
+    """
+    Pretty-prints an object only if the log message is actually emitted.
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pformat(self.obj)
+
+class ProtocolCapture(object):
+    """
+    Sampled capture of raw protocol lines to a rotating binary log.
+
+    Each record is a RECORD header (time in ns, direction, length) followed
+    by the line as received or sent, without CR LF. Lines are kept with
+    probability 'sample'. When the file grows past 'max_size', it is moved
+    to PATH.1 (older ones shifting up to PATH.<backups>) and a new one is
+    started.
+    """
+
+    RECORD = struct.Struct("<QBI")
+    IN, OUT = 0, 1
+
+    def __init__(self, path, sample=1.0, max_size=16 << 20, backups=3):
+        self.path = path
+        self.sample = sample
+        self.max_size = max_size
+        self.backups = backups
+        self.fh = open(path, "ab")
+
+    def write(self, direction, buf):
+        if self.sample < 1 and random.random() >= self.sample:
+            return
+        if not isinstance(buf, memoryview):
+            # lines from LineBuffer are already stripped
+            buf = buf.rstrip(b"\r\n")
+        self.fh.write(self.RECORD.pack(time.time_ns(), direction, len(buf)))
+        self.fh.write(buf)
+        if self.fh.tell() >= self.max_size:
+            self.rotate()
+
+    def rotate(self):
+        self.fh.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, i)):
+                os.replace("%s.%d" % (self.path, i),
+                           "%s.%d" % (self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.unlink(self.path)
+        self.fh = open(self.path, "ab")
+
+    def close(self):
+        self.fh.close()
+
+    @classmethod
+    def read(cls, path):
+        """
+        Yield (time in ns, direction, line) for each record in a capture.
+        """
+
+        with open(path, "rb") as fh:
+            while True:
+                header = fh.read(cls.RECORD.size)
+                if len(header) < cls.RECORD.size:
+                    break
+                ts, direction, length = cls.RECORD.unpack(header)
+                yield ts, direction, fh.read(length)
+
+def run_generator(gen, emit):
+    """
+    Run a process_frame() generator to completion, passing each event it
+    yields to emit(), and return its result.
+    """
+
+    try:
+        while True:
+            emit(next(gen))
+    except StopIteration as e:
+        return e.value
+
 
+def handles(*cmds):
+    """
+    Mark a method as the handler for the given commands or numerics.
+    """
+
+    def decorate(func):
+        func.irc_commands = cmds
+        return func
+    return decorate
+
+def find_handlers(cls):
+    """
+    Yield (command, method name) for the @handles() methods of a class.
+    """
+
+    for name in dir(cls):
+        for cmd in getattr(getattr(cls, name), "irc_commands", ()):
+            yield cmd, name
 
 class IrcClient(object):
-    def __init__(self, conn):
+    # every live client, for dump_counters()
+    instances = weakref.WeakSet()
+
+    # ProtocolCapture shared by all clients, if enabled
+    capture = None
+
+    def __init__(self, conn, name=None):
         self.conn = conn
+        self.name = name
+        self.instances.add(self)
+
+        # command -> tuple of handlers, so that dispatching a line is a
+        # single dict lookup
+        self.dispatch = {}
+        for cmd, name in find_handlers(type(self)):
+            self.register(cmd, getattr(self, name))
 
         self.settings = {
             "nick": "grawity",
@@ -126,6 +257,11 @@ class IrcClient(object):
         }
         self.low_connected = False
         self.high_connected = False
+        self.lines_in = 0
+        self.lines_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_by_cmd = Counter()
 
     def is_channel(self, name):
         return name[0] in self.isupport["CHANTYPES"]
@@ -137,7 +273,11 @@ class IrcClient(object):
         raise ValueError("name %r has only prefix characters" % name)
 
     def send_raw(self, buf):
-        trace("\033[35m--> %r\033[m" % buf)
+        log.debug("\033[35m--> %r\033[m", buf)
+        self.lines_out += 1
+        self.bytes_out += len(buf)
+        if self.capture:
+            self.capture.write(ProtocolCapture.OUT, buf)
         self.conn.write(buf)
         self.conn.flush()
 
@@ -153,14 +293,22 @@ class IrcClient(object):
         buf = self.conn.readline()
         if buf == b"":
             return None
+        self.bytes_in += len(buf)
         return buf
 
     def recv(self):
         buf = self.recv_raw()
         if buf is None:
             return None
+        return self.parse(buf)
+
+    def parse(self, buf):
+        if self.capture:
+            self.capture.write(ProtocolCapture.IN, buf)
         frame = Frame.parse(buf, parse_prefix=False)
-        trace("\033[36m<-- %r\033[m" % frame)
+        log.debug("\033[36m<-- %r\033[m", frame)
+        self.lines_in += 1
+        self.frames_by_cmd[frame.cmd] += 1
         return frame
 
     def handshake(self):
@@ -184,159 +332,194 @@ class IrcClient(object):
         if frame is None:
             yield "disconnected", {"reason": "connection-lost"}
             return False
-        elif frame.cmd == "ERROR":
-            error = " ".join(frame.args[1:])
-            trace("Server error: %r" % error)
-            yield "disconnected", {"reason": "server-error", "error": error}
-            return False
-        elif frame.cmd == "PING":
-            self.send("PONG %s" % " ".join(frame.args[1:]))
-        elif frame.cmd == "CAP":
-            sub = frame.args[2].upper()
-            if sub == "LS":
-                offered_caps = set(frame.args[3].split())
-                trace("Server offers capabilities: %s" % offered_caps)
-                missing_caps = self.required_caps - offered_caps
-                if missing_caps:
-                    trace("Server is missing required capabilities: %s" % missing_caps)
-                    self.send("QUIT")
-                    yield "disconnected", {
-                        "reason":   "missing-caps",
-                        "caps":     missing_caps,
-                        "refused":  False,
-                    }
-                request_caps = offered_caps & (self.wanted_caps | self.required_caps)
-                self.send("CAP REQ :%s" % " ".join(request_caps))
-            elif sub == "ACK":
-                acked_caps = set(frame.args[3].split())
-                trace("Server enabled capabilities: %s" % acked_caps)
-                self.enabled_caps |= acked_caps
-                if "sasl" in acked_caps:
-                    self.sasl_mech = SaslPLAIN(username=self.settings["nick"],
-                                               password=self.settings["pass"])
-                    trace("Starting SASL %s authentication" % self.sasl_mech.name)
-                    self.send("AUTHENTICATE %s" % self.sasl_mech.name)
-                else:
-                    self.send("CAP END")
-            elif sub == "NAK":
-                refused_caps = set(frame.args[3].split())
-                trace("Server refused capabilities: %s" % refused_caps)
+        for handler in self.dispatch.get(frame.cmd, ()):
+            ok = handler(frame)
+            if isinstance(ok, types.GeneratorType):
+                ok = yield from ok
+            if ok == False:
+                return False
+        return True
+
+    def register(self, cmd, handler):
+        """
+        Add a handler for a command or numeric, called after the existing
+        ones. The handler may return False to disconnect, or be a generator
+        yielding events.
+        """
+
+        self.dispatch[cmd] = self.dispatch.get(cmd, ()) + (handler,)
+
+    def add_plugin(self, plugin):
+        """
+        Register all methods of 'plugin' marked with @handles().
+        """
+
+        for cmd, name in find_handlers(type(plugin)):
+            self.register(cmd, getattr(plugin, name))
+
+    @handles("ERROR")
+    def on_error(self, frame):
+        error = " ".join(frame.args[1:])
+        log.warning("Server error: %r", error)
+        yield "disconnected", {"reason": "server-error", "error": error}
+        return False
+
+    @handles("PING")
+    def on_ping(self, frame):
+        self.send("PONG %s" % " ".join(frame.args[1:]))
+
+    @handles("CAP")
+    def on_cap(self, frame):
+        sub = frame.args[2].upper()
+        if sub == "LS":
+            offered_caps = set(frame.args[3].split())
+            log.info("Server offers capabilities: %s", offered_caps)
+            missing_caps = self.required_caps - offered_caps
+            if missing_caps:
+                log.error("Server is missing required capabilities: %s", missing_caps)
                 self.send("QUIT")
                 yield "disconnected", {
                     "reason":   "missing-caps",
-                    "caps":     refused_caps,
-                    "refused":  True,
+                    "caps":     missing_caps,
+                    "refused":  False,
                 }
-        elif frame.cmd == "AUTHENTICATE":
-            data = frame.args[1]
-            if data != "+":
-                self.sasl_mech.feed_input(b64decode(data))
-            if len(data) != 400:
-                outbuf = self.sasl_mech.get_output()
-                if outbuf is None:
-                    trace("SASL mechanism did not return any data")
-                    self.send("QUIT")
-                    yield "disconnected", {"reason": "auth-failed"}
-                for chunk in b64chunked(outbuf):
-                    self.send("AUTHENTICATE " + chunk)
-        elif frame.cmd == "001":
-            yield from self.check_low_connected()
-        elif frame.cmd == "005":
-            isupport_tokens = frame.args[2:-1]
-            for isupport_item in isupport_tokens:
-                if "=" in isupport_item:
-                    k, v = isupport_item.split("=", 1)
-                    if k == "CHANMODES":
-                        a, b, c, d = v.split(",", 3)
-                        self.isupport["CHANMODES.a"] = set(a)
-                        self.isupport["CHANMODES.b"] = set(b)
-                        self.isupport["CHANMODES.c"] = set(c)
-                        self.isupport["CHANMODES.d"] = set(d)
-                    elif k in {"CHANLIMIT", "MAXLIST"}:
-                        self.isupport["%s.types" % k] = {}
-                        limit_tokens = v.split(",")
-                        for limit_item in limit_tokens:
-                            types, limit = limit_item.split(":", 1)
-                            for type in types:
-                                self.isupport["%s.types" % k][type] = int(limit)
-                    elif k in {"CHANNELLEN", "NICKLEN", "MODES",
-                               "MONITOR", "TOPICLEN"}:
-                        v = int(v)
-                    elif k == "CHANTYPES":
-                        v = set(v)
-                    elif k == "EXTBAN":
-                        char, types = v.split(",", 1)
-                        self.isupport["EXTBAN.char"] = char
-                        self.isupport["EXTBAN.types"] = set(types)
-                    elif k == "NAMESX":
-                        if "multi-prefix" not in enabled_caps:
-                            self.send("PROTOCTL NAMESX")
-                    elif k == "UHNAMES":
-                        if "userhost-in-names" not in enabled_caps:
-                            self.send("PROTOCTL UHNAMES")
-                    elif k == "PREFIX":
-                        self.isupport["PREFIX.modes"] = {}
-                        self.isupport["PREFIX.chars"] = {}
-                        modes, chars = v[1:].split(")", 1)
-                        num = len(modes)
-                        for i in range(num):
-                            self.isupport["PREFIX.modes"][modes[i]] = chars[i]
-                            self.isupport["PREFIX.chars"][chars[i]] = modes[i]
-                            self.isupport["PREFIX.ranks"][modes[i]] = num - i
-                            self.isupport["PREFIX.ranks"][chars[i]] = num - i
-                else:
-                    k, v = isupport_item, True
-                self.isupport[k] = v
-            trace(pformat(self.isupport))
-        elif frame.cmd == "XXX END OF MOTD":
-            yield from self.check_high_connected()
-        elif frame.cmd == "433":
-            trace("Nickname %r is already in use" % self.settings["nick"])
-            nick_counter += 1
-            self.current_nick = "%s%d" % (self.settings["nick"], self.nick_counter)
-            self.send("NICK " + self.current_nick)
-        elif frame.cmd == "903":
-            trace("Authentication successful!")
-            self.send("CAP END")
-        elif frame.cmd == "904":
-            if self.sasl_mech.step == 0:
-                trace("Authentication failed; server does not support SASL %r" %
-                      (self.sasl_mech.name))
+            request_caps = offered_caps & (self.wanted_caps | self.required_caps)
+            self.send("CAP REQ :%s" % " ".join(request_caps))
+        elif sub == "ACK":
+            acked_caps = set(frame.args[3].split())
+            log.info("Server enabled capabilities: %s", acked_caps)
+            self.enabled_caps |= acked_caps
+            if "sasl" in acked_caps:
+                self.sasl_mech = SaslPLAIN(username=self.settings["nick"],
+                                           password=self.settings["pass"])
+                log.info("Starting SASL %s authentication", self.sasl_mech.name)
+                self.send("AUTHENTICATE %s" % self.sasl_mech.name)
             else:
-                trace("Authentication failed; the credentials were incorrect")
-            self.send("QUIT")
-            yield "disconnected", {"reason": "auth-failed"}
-        elif frame.cmd == "908":
-            trace("Authentication failed; server does not support SASL %r" %
-                  (self.sasl_mech.name))
+                self.send("CAP END")
+        elif sub == "NAK":
+            refused_caps = set(frame.args[3].split())
+            log.error("Server refused capabilities: %s", refused_caps)
             self.send("QUIT")
-            yield "disconnected", {"reason": "auth-failed"}
-        elif frame.cmd == "PRIVMSG":
-            if len(frame.args) != 3:
-                return True
-            _, rcpt, text = frame.args
-            yield "message", {
-                "from":     frame.prefix,
-                "to":       rcpt,
-                "text":     text,
-                "private":  not self.is_channel(rcpt),
-            }
-        elif frame.cmd == "NOTICE":
-            if len(frame.args) != 3:
-                return True
-            _, rcpt, text = frame.args
-            yield "notice", {
-                "from":     frame.prefix,
-                "to":       rcpt,
-                "text":     text,
-                "private":  not self.is_channel(rcpt),
+            yield "disconnected", {
+                "reason":   "missing-caps",
+                "caps":     refused_caps,
+                "refused":  True,
             }
-        return True
+
+    @handles("AUTHENTICATE")
+    def on_authenticate(self, frame):
+        data = frame.args[1]
+        if data != "+":
+            self.sasl_mech.feed_input(base64.b64decode(data))
+        if len(data) != 400:
+            outbuf = self.sasl_mech.get_output()
+            if outbuf is None:
+                log.error("SASL mechanism did not return any data")
+                self.send("QUIT")
+                yield "disconnected", {"reason": "auth-failed"}
+            for chunk in b64chunked(outbuf):
+                self.send("AUTHENTICATE " + chunk)
+
+    @handles("001")
+    def on_welcome(self, frame):
+        yield from self.check_low_connected()
+
+    @handles("005")
+    def on_isupport(self, frame):
+        isupport_tokens = frame.args[2:-1]
+        for isupport_item in isupport_tokens:
+            if "=" in isupport_item:
+                k, v = isupport_item.split("=", 1)
+                if k == "CHANMODES":
+                    a, b, c, d = v.split(",", 3)
+                    self.isupport["CHANMODES.a"] = set(a)
+                    self.isupport["CHANMODES.b"] = set(b)
+                    self.isupport["CHANMODES.c"] = set(c)
+                    self.isupport["CHANMODES.d"] = set(d)
+                elif k in {"CHANLIMIT", "MAXLIST"}:
+                    self.isupport["%s.types" % k] = {}
+                    limit_tokens = v.split(",")
+                    for limit_item in limit_tokens:
+                        types, limit = limit_item.split(":", 1)
+                        for type in types:
+                            self.isupport["%s.types" % k][type] = int(limit)
+                elif k in {"CHANNELLEN", "NICKLEN", "MODES",
+                           "MONITOR", "TOPICLEN"}:
+                    v = int(v)
+                elif k == "CHANTYPES":
+                    v = set(v)
+                elif k == "EXTBAN":
+                    char, types = v.split(",", 1)
+                    self.isupport["EXTBAN.char"] = char
+                    self.isupport["EXTBAN.types"] = set(types)
+                elif k == "PREFIX":
+                    self.isupport["PREFIX.modes"] = {}
+                    self.isupport["PREFIX.chars"] = {}
+                    modes, chars = v[1:].split(")", 1)
+                    num = len(modes)
+                    for i in range(num):
+                        self.isupport["PREFIX.modes"][modes[i]] = chars[i]
+                        self.isupport["PREFIX.chars"][chars[i]] = modes[i]
+                        self.isupport["PREFIX.ranks"][modes[i]] = num - i
+                        self.isupport["PREFIX.ranks"][chars[i]] = num - i
+            else:
+                k, v = isupport_item, True
+                if k == "NAMESX":
+                    if "multi-prefix" not in self.enabled_caps:
+                        self.send("PROTOCTL NAMESX")
+                elif k == "UHNAMES":
+                    if "userhost-in-names" not in self.enabled_caps:
+                        self.send("PROTOCTL UHNAMES")
+            self.isupport[k] = v
+        log.debug("ISUPPORT: %s", Pretty(self.isupport))
+
+    @handles("376", "422")
+    def on_end_of_motd(self, frame):
+        yield from self.check_high_connected()
+
+    @handles("433")
+    def on_nick_in_use(self, frame):
+        log.info("Nickname %r is already in use", self.current_nick)
+        self.nick_counter += 1
+        self.current_nick = "%s%d" % (self.settings["nick"], self.nick_counter)
+        self.send("NICK " + self.current_nick)
+
+    @handles("903")
+    def on_sasl_success(self, frame):
+        log.info("Authentication successful!")
+        self.send("CAP END")
+
+    @handles("904")
+    def on_sasl_failed(self, frame):
+        if self.sasl_mech.step == 0:
+            log.error("Authentication failed; server does not support SASL %r",
+                      self.sasl_mech.name)
+        else:
+            log.error("Authentication failed; the credentials were incorrect")
+        self.send("QUIT")
+        yield "disconnected", {"reason": "auth-failed"}
+
+    @handles("908")
+    def on_sasl_mechs(self, frame):
+        log.error("Authentication failed; server does not support SASL %r",
+                  self.sasl_mech.name)
+        self.send("QUIT")
+        yield "disconnected", {"reason": "auth-failed"}
+
+    @handles("PRIVMSG", "NOTICE")
+    def on_message(self, frame):
+        if len(frame.args) != 3:
+            return
+        _, rcpt, text = frame.args
+        yield "message" if frame.cmd == "PRIVMSG" else "notice", {
+            "from":     frame.prefix,
+            "to":       rcpt,
+            "text":     text,
+            "private":  not self.is_channel(rcpt),
+        }
 
     def process(self, buf):
-        frame = Frame.parse(buf, parse_prefix=False)
-        trace("\033[36m<-- %r\033[m" % frame)
-        return self.process_frame(frame)
+        return self.process_frame(self.parse(buf))
 
     def run(self):
         self.handshake()
@@ -349,9 +532,289 @@ class IrcClient(object):
             if ok == False:
                 break
 
+    async def run_async(self, on_event):
+        """
+        Drive the client from an asyncio stream (self.conn must be a
+        StreamWrapper), calling on_event(event, data) for each event.
+
+        Frames are processed as soon as they are read, so PINGs are answered
+        from the read loop itself; events are handed to a separate task, so
+        a slow (or async) handler does not hold up reading.
+        """
+
+        events = asyncio.Queue()
+        consumer = asyncio.ensure_future(dispatch_events(events, on_event))
+        buf = LineBuffer()
+        self.handshake()
+        try:
+            ok = True
+            while ok != False:
+                data = await self.conn.reader.read(65536)
+                self.bytes_in += len(data)
+                if data:
+                    gens = [self.process(line) for line in buf.feed(data)]
+                else:
+                    gens = [self.process_frame(None)]
+                for gen in gens:
+                    ok = run_generator(gen, events.put_nowait)
+                    if ok == False:
+                        break
+                await self.conn.writer.drain()
+        finally:
+            events.put_nowait(None)
+            await consumer
+
     def send_message(self, rcpt, text):
         self.sendv("PRIVMSG", rcpt, text)
 
+# Lowercasing tables for each ISUPPORT CASEMAPPING. These only touch ASCII,
+# so they are applied to the UTF-8 bytes, which bytes.translate() does
+# several times faster than str.translate() with a dict.
+CASEMAPPINGS = {
+    "ascii":            bytes.maketrans(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+                                        b"abcdefghijklmnopqrstuvwxyz"),
+    "rfc1459":          bytes.maketrans(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~",
+                                        b"abcdefghijklmnopqrstuvwxyz{}|^"),
+    "strict-rfc1459":   bytes.maketrans(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\",
+                                        b"abcdefghijklmnopqrstuvwxyz{}|"),
+}
+
+def split_hostmask(mask):
+    nick, _, host = mask.partition("@")
+    nick, _, user = nick.partition("!")
+    return nick, user or None, host or None
+
+class User(object):
+    __slots__ = ("nick", "user", "host", "account", "channels")
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.user = None
+        self.host = None
+        self.account = None
+        self.channels = set()
+
+    def __repr__(self):
+        return "<User %s>" % self.nick
+
+class Channel(object):
+    __slots__ = ("name", "members", "names", "synced")
+
+    def __init__(self, name):
+        self.name = name
+        # User -> bitmask of prefix modes
+        self.members = {}
+        # members collected from RPL_NAMREPLY until RPL_ENDOFNAMES
+        self.names = None
+        self.synced = False
+
+    def __repr__(self):
+        return "<Channel %s (%d members)>" % (self.name, len(self.members))
+
+class StateTracker(object):
+    """
+    Channel membership tracker, added to an IrcClient as a plugin.
+
+    Users and channels are indexed by their casemapped names. Channel
+    members are keyed by User object, so a nick change only re-indexes the
+    user once however many channels they are in, and each member's prefix
+    modes are kept as a bitmask (lowest bit = highest rank in PREFIX).
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.users = {}
+        self.channels = {}
+        self.casemap = None
+        self.update_isupport()
+
+    def update_isupport(self):
+        isupport = self.client.isupport
+        casemap = CASEMAPPINGS.get(isupport["CASEMAPPING"],
+                                   CASEMAPPINGS["rfc1459"])
+        if casemap is not self.casemap:
+            self.casemap = casemap
+            self.users = {self.fold(u.nick): u for u in self.users.values()}
+            self.channels = {self.fold(c.name): c
+                             for c in self.channels.values()}
+        modes = isupport["PREFIX.modes"]
+        self.mode_bits = {m: 1 << i for i, m in enumerate(modes)}
+        self.char_bits = {c: 1 << i for i, c in enumerate(modes.values())}
+        self.prefix_chars = "".join(modes.values())
+
+    def fold(self, name):
+        return name.encode("utf-8").translate(self.casemap).decode("utf-8")
+
+    def is_me(self, nick):
+        return self.fold(nick) == self.fold(self.client.current_nick)
+
+    def get_user(self, nick):
+        return self.users.get(self.fold(nick))
+
+    def get_channel(self, name):
+        return self.channels.get(self.fold(name))
+
+    def mode_prefix(self, bits):
+        if not bits:
+            return ""
+        return self.prefix_chars[(bits & -bits).bit_length() - 1]
+
+    def member_modes(self, name, nick):
+        """
+        Return the prefix modes (e.g. "ov") of a channel member, or None if
+        they are not on the channel.
+        """
+
+        chan = self.get_channel(name)
+        user = self.get_user(nick)
+        if chan is None or user not in chan.members:
+            return None
+        bits = chan.members[user]
+        return "".join(m for m, bit in self.mode_bits.items() if bits & bit)
+
+    def names(self, name):
+        chan = self.get_channel(name)
+        return [self.mode_prefix(bits) + user.nick
+                for user, bits in chan.members.items()]
+
+    def _user(self, nick, user=None, host=None):
+        key = self.fold(nick)
+        obj = self.users.get(key)
+        if obj is None:
+            obj = self.users[key] = User(nick)
+        if host:
+            obj.user, obj.host = user, host
+        return obj
+
+    def _add(self, chan, user, bits=0):
+        chan.members[user] = bits
+        user.channels.add(chan)
+
+    def _remove(self, chan, user):
+        chan.members.pop(user, None)
+        if chan.names:
+            chan.names.pop(user, None)
+        user.channels.discard(chan)
+        if not user.channels:
+            self.users.pop(self.fold(user.nick), None)
+
+    def _drop_channel(self, chan):
+        for user in list(chan.members):
+            self._remove(chan, user)
+        del self.channels[self.fold(chan.name)]
+
+    @handles("005")
+    def on_isupport(self, frame):
+        self.update_isupport()
+
+    @handles("JOIN")
+    def on_join(self, frame):
+        nick, user, host = split_hostmask(frame.prefix)
+        name = frame.args[1]
+        if self.is_me(nick):
+            self.channels.setdefault(self.fold(name), Channel(name))
+        chan = self.get_channel(name)
+        if chan is None:
+            return
+        obj = self._user(nick, user, host)
+        if len(frame.args) > 2:
+            # extended-join
+            obj.account = None if frame.args[2] == "*" else frame.args[2]
+        self._add(chan, obj)
+
+    @handles("PART", "KICK")
+    def on_part(self, frame):
+        chan = self.get_channel(frame.args[1])
+        if chan is None:
+            return
+        if frame.cmd == "KICK":
+            nick = frame.args[2]
+        else:
+            nick = split_hostmask(frame.prefix)[0]
+        if self.is_me(nick):
+            self._drop_channel(chan)
+        else:
+            user = self.get_user(nick)
+            if user:
+                self._remove(chan, user)
+
+    @handles("QUIT")
+    def on_quit(self, frame):
+        user = self.users.pop(self.fold(split_hostmask(frame.prefix)[0]), None)
+        if user:
+            for chan in user.channels:
+                chan.members.pop(user, None)
+                if chan.names:
+                    chan.names.pop(user, None)
+
+    @handles("NICK")
+    def on_nick(self, frame):
+        old = split_hostmask(frame.prefix)[0]
+        new = frame.args[1]
+        if self.is_me(old):
+            self.client.current_nick = new
+        user = self.users.pop(self.fold(old), None)
+        if user:
+            user.nick = new
+            self.users[self.fold(new)] = user
+
+    @handles("MODE")
+    def on_mode(self, frame):
+        chan = self.get_channel(frame.args[1])
+        if chan is None or len(frame.args) < 3:
+            return
+        isupport = self.client.isupport
+        params = iter(frame.args[3:])
+        adding = True
+        for mode in frame.args[2]:
+            if mode == "+":
+                adding = True
+            elif mode == "-":
+                adding = False
+            elif mode in self.mode_bits:
+                user = self.get_user(next(params, ""))
+                if user in chan.members:
+                    if adding:
+                        chan.members[user] |= self.mode_bits[mode]
+                    else:
+                        chan.members[user] &= ~self.mode_bits[mode]
+            elif mode in isupport["CHANMODES.a"] \
+                    or mode in isupport["CHANMODES.b"] \
+                    or (adding and mode in isupport["CHANMODES.c"]):
+                next(params, None)
+
+    @handles("353")
+    def on_names(self, frame):
+        chan = self.get_channel(frame.args[3])
+        if chan is None:
+            return
+        if chan.names is None:
+            chan.names = {}
+        char_bits = self.char_bits
+        for item in frame.args[4].split():
+            bits = 0
+            for i, c in enumerate(item):
+                if c not in char_bits:
+                    break
+                bits |= char_bits[c]
+            else:
+                continue
+            user = self._user(*split_hostmask(item[i:]))
+            chan.names[user] = bits
+            user.channels.add(chan)
+
+    @handles("366")
+    def on_end_of_names(self, frame):
+        chan = self.get_channel(frame.args[2])
+        if chan is None or chan.names is None:
+            return
+        names, chan.names = chan.names, None
+        for user in list(chan.members):
+            if user not in names:
+                self._remove(chan, user)
+        chan.members = names
+        chan.synced = True
+
 class PipeWrapper(object):
     def __init__(self, rd, wr):
         self.rd = rd
@@ -377,7 +840,426 @@ class PipeWrapper(object):
     def flush(self):
         return self.wr.flush()
 
-conn = PipeWrapper.from_stdio()
-client = IrcClient(conn)
-for event, data in client.run():
-    trace("%s:" % event, pformat(data))
+# commands which skip ahead of queued messages (PING, so that LagMeter
+# measures the network rather than the queue)
+PRIORITY_COMMANDS = {b"PING", b"PONG", b"CAP", b"AUTHENTICATE"}
+
+class SendQueue(object):
+    """
+    Outgoing line queue with token-bucket flood control.
+
+    Up to 'burst' lines are sent at once, after which lines are released at
+    'rate' lines per second. PRIORITY_COMMANDS go into a separate lane that
+    is always sent first and never held back (though it still uses up
+    tokens). Everything that can be sent is joined into a single write()
+    once per event loop iteration.
+    """
+
+    def __init__(self, writer, burst=5, rate=0.5):
+        self.writer = writer
+        self.burst = burst
+        self.rate = rate
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.urgent = deque()
+        self.bulk = deque()
+        self.loop = asyncio.get_running_loop()
+        self.pending = None
+        self.timer = None
+
+    def __len__(self):
+        return len(self.urgent) + len(self.bulk)
+
+    def put(self, buf):
+        cmd = buf.split(None, 1)[:1]
+        if cmd and cmd[0].upper() in PRIORITY_COMMANDS:
+            self.urgent.append(buf)
+        else:
+            self.bulk.append(buf)
+        if self.pending is None:
+            self.pending = self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.pending = None
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        now = time.monotonic()
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+        out = []
+        while self.urgent:
+            out.append(self.urgent.popleft())
+            tokens = max(tokens - 1, 0)
+        while self.bulk and tokens >= 1:
+            out.append(self.bulk.popleft())
+            tokens -= 1
+        self.tokens = tokens
+
+        if out:
+            self.writer.write(b"".join(out))
+        if self.bulk:
+            delay = (1 - tokens) / self.rate
+            self.timer = self.loop.call_later(delay, self.flush)
+
+    def close(self):
+        """
+        Write out whatever is still queued, ignoring the flood limit.
+        """
+
+        for handle in (self.pending, self.timer):
+            if handle:
+                handle.cancel()
+        self.pending = self.timer = None
+        out = list(self.urgent) + list(self.bulk)
+        self.urgent.clear()
+        self.bulk.clear()
+        if out:
+            self.writer.write(b"".join(out))
+
+class StreamWrapper(object):
+    def __init__(self, reader, writer, burst=5, rate=0.5):
+        self.reader = reader
+        self.writer = writer
+        self.queue = SendQueue(writer, burst, rate)
+
+    def write(self, buf):
+        self.queue.put(buf)
+
+    def flush(self):
+        # SendQueue writes out queued lines on its own
+        pass
+
+    def close(self):
+        self.queue.close()
+        self.writer.close()
+
+async def dispatch_events(queue, on_event):
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        try:
+            result = on_event(*item)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            log.error("Event handler failed: %r", e)
+
+def print_event(event, data):
+    log.info("%s: %s", event, Pretty(data))
+
+async def connect(host, port=6667, ssl=None, on_event=print_event,
+                  burst=5, rate=0.5):
+    reader, writer = await asyncio.open_connection(host, port, ssl=ssl)
+    conn = StreamWrapper(reader, writer, burst, rate)
+    client = IrcClient(conn, host)
+    client.add_plugin(StateTracker(client))
+    try:
+        await client.run_async(on_event)
+    finally:
+        conn.close()
+    return client
+
+async def connect_all(servers):
+    tasks = []
+    for server in servers:
+        host, _, port = server.rpartition(":")
+        if not host or not port.isdigit():
+            host, port = server, 6667
+        tasks.append(connect(host, int(port)))
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+class LagMeter(object):
+    """
+    Measures the round-trip time of a PING sent to the server every
+    'interval' seconds; added to an IrcClient as a plugin.
+    """
+
+    def __init__(self, client, interval=30):
+        self.client = client
+        self.interval = interval
+        self.last_lag = None
+        self.pending = None
+
+    @property
+    def lag(self):
+        if self.pending:
+            # no reply yet; the lag is at least this much
+            waited = time.monotonic() - self.pending[1]
+            if self.last_lag is None or waited > self.last_lag:
+                return waited
+        return self.last_lag
+
+    async def run(self):
+        count = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.pending is None:
+                count += 1
+                self.pending = "lag%d" % count, time.monotonic()
+                self.client.send("PING :%s" % self.pending[0])
+
+    @handles("PONG")
+    def on_pong(self, frame):
+        if self.pending and frame.args[-1] == self.pending[0]:
+            self.last_lag = time.monotonic() - self.pending[1]
+            self.pending = None
+
+class Network(object):
+    """
+    One configured network, reconnected with jittered exponential backoff
+    for as long as the supervisor runs.
+    """
+
+    min_delay = 5
+    max_delay = 600
+
+    def __init__(self, name, config):
+        self.name = name
+        self.host = config["host"]
+        self.tls = config.getboolean("tls", False)
+        self.port = config.getint("port", 6697 if self.tls else 6667)
+        self.burst = config.getint("burst", 5)
+        self.rate = config.getfloat("rate", 0.5)
+        self.lag_interval = config.getfloat("lag_interval", 30)
+        self.settings = {k: config[k] for k in ("nick", "pass") if k in config}
+        self.client = None
+        self.tracker = None
+        self.lagmeter = None
+        self.sample = (time.monotonic(), None, 0, 0)
+
+    def on_event(self, event, data):
+        log.info("[%s] %s: %s", self.name, event, Pretty(data))
+
+    async def run_once(self):
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, ssl=True if self.tls else None)
+        conn = StreamWrapper(reader, writer, self.burst, self.rate)
+        self.client = IrcClient(conn, self.name)
+        self.client.settings.update(self.settings)
+        self.client.current_nick = self.client.settings["nick"]
+        self.tracker = StateTracker(self.client)
+        self.client.add_plugin(self.tracker)
+        self.lagmeter = LagMeter(self.client, self.lag_interval)
+        self.client.add_plugin(self.lagmeter)
+        pinger = asyncio.ensure_future(self.lagmeter.run())
+        try:
+            await self.client.run_async(self.on_event)
+        finally:
+            pinger.cancel()
+            conn.close()
+
+    async def run(self):
+        delay = self.min_delay
+        while True:
+            started = time.monotonic()
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except OSError as e:
+                log.warning("[%s] Connection failed: %s", self.name, e)
+            except Exception:
+                # a bug in one network's handlers must not stop the others
+                log.exception("[%s] Client failed", self.name)
+            if time.monotonic() - started > self.max_delay:
+                # the connection was up for a while; start over
+                delay = self.min_delay
+            wait = delay / 2 + random.uniform(0, delay / 2)
+            log.info("[%s] Reconnecting in %.1f seconds", self.name, wait)
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, self.max_delay)
+
+    def stats(self):
+        """
+        Return the current lag, send queue depth, and lines per second in
+        each direction since the previous call.
+        """
+
+        client = self.client
+        now = time.monotonic()
+        then, last_client, last_in, last_out = self.sample
+        if client is not last_client:
+            last_in = last_out = 0
+        stats = {"connected": False, "lag": None, "queue": 0,
+                 "in/s": 0.0, "out/s": 0.0}
+        if client:
+            elapsed = max(now - then, 1e-6)
+            stats.update({
+                "connected":    not client.conn.writer.is_closing(),
+                "lag":          self.lagmeter.lag,
+                "queue":        len(client.conn.queue),
+                "in/s":         (client.lines_in - last_in) / elapsed,
+                "out/s":        (client.lines_out - last_out) / elapsed,
+            })
+            self.sample = (now, client, client.lines_in, client.lines_out)
+        return stats
+
+class Supervisor(object):
+    """
+    Runs a bot on every network in the config file within one event loop,
+    logging each connection's stats every 'stats_interval' seconds.
+    """
+
+    def __init__(self, path):
+        config = configparser.ConfigParser()
+        with open(path) as fh:
+            config.read_file(fh)
+        self.networks = [Network(name, config[name])
+                         for name in config.sections()]
+        self.stats_interval = config.getfloat("DEFAULT", "stats_interval",
+                                              fallback=60)
+
+    def stats(self):
+        return {net.name: net.stats() for net in self.networks}
+
+    def print_stats(self):
+        for name, stats in self.stats().items():
+            lag = "%.3fs" % stats["lag"] if stats["lag"] is not None else "-"
+            log.info("[%s] %s, lag %s, queue %d, %.1f lines/s in, %.1f out",
+                     name, "up" if stats["connected"] else "down", lag,
+                     stats["queue"], stats["in/s"], stats["out/s"])
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self.print_stats()
+
+    async def run(self):
+        reporter = asyncio.ensure_future(self.report())
+        try:
+            await asyncio.gather(*[net.run() for net in self.networks])
+        finally:
+            reporter.cancel()
+
+def default_config_path():
+    config_dir = os.environ.get("XDG_CONFIG_HOME") or \
+                 os.path.expanduser("~/.config")
+    return os.path.join(config_dir, "nullroute", "irc-bot.conf")
+
+def dump_counters(*args):
+    for client in list(IrcClient.instances):
+        print("[%s] %d lines (%d bytes) in, %d lines (%d bytes) out" % (
+              client.name or "irc", client.lines_in, client.bytes_in,
+              client.lines_out, client.bytes_out), file=sys.stderr)
+        print("[%s] %s" % (client.name or "irc", ", ".join(
+              "%s %d" % item for item in client.frames_by_cmd.most_common())),
+              file=sys.stderr)
+
+class NullConnection(object):
+    def write(self, buf):
+        pass
+
+    def flush(self):
+        pass
+
+def bench_tracker(count):
+    """
+    Feed StateTracker two channels of 'count' users each, then rename, op
+    and quit all of them, reporting the time per line and the memory held
+    per user.
+    """
+
+    me = IrcClient(NullConnection()).current_nick
+    nicks = ["user%d[%d]" % (i, i * 7919 % 1000) for i in range(count)]
+
+    def names(chan):
+        for i in range(0, count, 20):
+            yield ":srv 353 %s = %s :%s" % (me, chan, " ".join(
+                "@+"[j % 2] * (j % 3 == 0) + "%s!u@host%d.example" % (n, j)
+                for j, n in enumerate(nicks[i:i+20])))
+        yield ":srv 366 %s %s :End of /NAMES list." % (me, chan)
+
+    phases = [
+        ("join",    [":%s!u@h JOIN #a" % me, ":%s!u@h JOIN #b" % me]),
+        ("names",   list(names("#a")) + list(names("#b"))),
+        ("nick",    [":%s!u@h NICK :%s_" % (n, n.upper()) for n in nicks]),
+        ("mode",    [":srv MODE #a +o-v %s_ %s_" % (n, n) for n in nicks]),
+        ("quit",    [":%s_!u@h QUIT :bye" % n for n in nicks]),
+    ]
+    phases = [(name, [Frame.parse(line.encode(), parse_prefix=False)
+                      for line in lines])
+              for name, lines in phases]
+
+    def run(frames):
+        for frame in frames:
+            run_generator(client.process_frame(frame), lambda event: None)
+
+    # first pass: memory held once both channels are synced
+    client = IrcClient(NullConnection())
+    client.add_plugin(StateTracker(client))
+    tracemalloc.start()
+    for name, frames in phases[:2]:
+        run(frames)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%d users in 2 channels: %.0f bytes/user" % (count, size / count))
+
+    client = IrcClient(NullConnection())
+    tracker = StateTracker(client)
+    client.add_plugin(tracker)
+    for name, frames in phases:
+        t = time.perf_counter()
+        run(frames)
+        t = time.perf_counter() - t
+        print("%-8s %8d lines %8.3f s %8.0f ns/line" % (
+              name, len(frames), t, t * 1e9 / len(frames)))
+        if name == "mode":
+            assert len(tracker.get_channel("#A").members) == count
+            assert len(tracker.users) == count
+            assert tracker.member_modes("#a", nicks[0].upper() + "_") == "o"
+    assert not tracker.users
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("servers", nargs="*", metavar="HOST[:PORT]",
+                        help="servers to connect to (default: IRC on stdio)")
+    parser.add_argument("-c", "--config", nargs="?", const=default_config_path(),
+                        help="run every network in a config file")
+    parser.add_argument("--bench-tracker", type=int, metavar="N", nargs="?",
+                        const=50000,
+                        help="benchmark StateTracker with N-user channels")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="log the protocol traffic")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="only log warnings and errors")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="capture the raw protocol to a binary log")
+    parser.add_argument("--capture-sample", type=float, default=1.0,
+                        metavar="RATE",
+                        help="fraction of lines to capture (default: all)")
+    parser.add_argument("--capture-size", type=float, default=16,
+                        metavar="MB",
+                        help="rotate the capture log at this size")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s",
+                        level=logging.DEBUG if args.verbose else
+                              logging.WARNING if args.quiet else
+                              logging.INFO)
+    if args.capture:
+        IrcClient.capture = ProtocolCapture(args.capture, args.capture_sample,
+                                            int(args.capture_size * 1e6))
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, dump_counters)
+
+    if args.bench_tracker:
+        sys.exit(bench_tracker(args.bench_tracker))
+    elif args.config:
+        asyncio.run(Supervisor(args.config).run())
+    elif args.servers:
+        for result in asyncio.run(connect_all(args.servers)):
+            if isinstance(result, Exception):
+                log.error("Connection failed: %r", result)
+    else:
+        conn = PipeWrapper.from_stdio()
+        client = IrcClient(conn)
+        client.add_plugin(StateTracker(client))
+        for event, data in client.run():
+            print_event(event, data)
+
+if __name__ == "__main__":
+    main()
@@ -8,12 +8,22 @@ import base64
 import socket
 import re
 
+# maximum line length, including CR LF, not counting the tags
+MAX_LINE_LENGTH = 512
+
+# maximum length of the tags, including the leading "@" and trailing space
+MAX_TAGS_LENGTH = 8191
+
 class InvalidPrefixError(ValueError):
     pass
 
 class Prefix(object):
+    __slots__ = ("nick", "user", "host", "is_server")
+
     def __init__(self, nick=None, user=None, host=None, is_server=False):
         if is_server:
+            self.nick = None
+            self.user = None
             self.host = host or nick
         else:
             self.nick = nick
@@ -23,17 +33,18 @@ class Prefix(object):
 
     @classmethod
     def parse(cls, prefix):
-        if len(prefix) == 0:
+        if not prefix:
             return None
 
-        dpos = prefix.find(".") + 1
         upos = prefix.find("!") + 1
         hpos = prefix.find("@", upos) + 1
 
         if upos == 1 or hpos == 1:
             return None
 
-        self = cls()
+        # fill in the slots directly, skipping __init__
+        self = cls.__new__(cls)
+        self.is_server = False
         if upos > 0:
             self.nick = prefix[:upos-1]
             if hpos > 0:
@@ -41,14 +52,18 @@ class Prefix(object):
                 self.host = prefix[hpos:]
             else:
                 self.user = prefix[upos:]
+                self.host = None
         elif hpos > 0:
             self.nick = prefix[:hpos-1]
+            self.user = None
             self.host = prefix[hpos:]
-        elif dpos > 0:
+        elif "." in prefix:
+            self.nick = self.user = None
             self.host = prefix
             self.is_server = True
         else:
             self.nick = prefix
+            self.user = self.host = None
 
         return self
 
@@ -87,12 +102,180 @@ class Prefix(object):
     def to_a(self):
         return [self.nick, self.user, self.host, self.is_server]
 
+# tags, prefix and the rest of a line (already stripped of CR/LF)
+_LINE_RE = re.compile(rb" *(?:@([^ ]*) *)?(?::([^ ]*) +)?(.*)", re.S)
+_LINE_LONE_PREFIX_RE = re.compile(rb" *(?:@([^ ]*) *)?(?::([^ ]*)(?: +|$))?(.*)", re.S)
+
+def _split_params(rest):
+    """
+    Split the command and parameters part of a line on spaces, up to the
+    first token starting with a colon, which extends to the end of line.
+    """
+
+    if rest[:1] == ":":
+        return [rest[1:]]
+    pos = rest.find(" :")
+    argv = (rest if pos < 0 else rest[:pos]).split(" ")
+    if "" in argv:
+        # only when separated by more than one space
+        argv = [arg for arg in argv if arg]
+    if pos >= 0:
+        argv.append(rest[pos+2:])
+    return argv
+
+# IRCv3 message-tag value escaping
+_TAG_ESCAPE = str.maketrans({
+    ";":    "\\:",
+    " ":    "\\s",
+    "\\":   "\\\\",
+    "\r":   "\\r",
+    "\n":   "\\n",
+})
+_TAG_UNESCAPE = {
+    ":":    ";",
+    "s":    " ",
+    "\\":   "\\",
+    "r":    "\r",
+    "n":    "\n",
+}
+_TAG_UNESCAPE_RE = re.compile(r"\\(.?)", re.S)
+
+def _unescape_char(m):
+    char = m.group(1)
+    return _TAG_UNESCAPE.get(char, char)
+
+def escape_tag_value(value):
+    return value.translate(_TAG_ESCAPE)
+
+def unescape_tag_value(value):
+    if "\\" not in value:
+        return value
+    return _TAG_UNESCAPE_RE.sub(_unescape_char, value)
+
+def parse_tags(tags):
+    """
+    Parse the tag block of a message (without the leading "@") into a dict,
+    unescaping the values. Tags without a value are set to True.
+    """
+
+    out = {}
+    for item in tags.split(";"):
+        k, sep, v = item.partition("=")
+        if not sep:
+            out[k] = True
+        elif "\\" in v:
+            out[k] = _TAG_UNESCAPE_RE.sub(_unescape_char, v)
+        else:
+            out[k] = v
+    return out
+
+def unparse_tags(tags):
+    return ";".join([k if v is True or v == "" else
+                     k + "=" + escape_tag_value(v)
+                     for k, v in tags.items()])
+
+# Shared str objects for common commands, so that buffered frames do not
+# each hold their own copy.
+_COMMANDS = {cmd.encode(): cmd for cmd in [
+    "PRIVMSG", "NOTICE", "JOIN", "PART", "QUIT", "NICK", "MODE", "KICK",
+    "TOPIC", "INVITE", "PING", "PONG", "ERROR", "CAP", "AUTHENTICATE",
+    "AWAY", "ACCOUNT", "CHGHOST", "SETNAME", "TAGMSG", "BATCH", "WALLOPS",
+] + ["%03d" % i for i in range(1000)]}
+
+def _intern_cmd(cmd):
+    out = _COMMANDS.get(cmd)
+    if out is None:
+        out = cmd.decode("utf-8", "replace").upper()
+        out = _COMMANDS.get(out.encode(), out)
+    return out
+
+_UNSET = object()
+
 class Frame(object):
+    __slots__ = ("_tags", "_prefix", "_cmd", "_args",
+                 "_raw_tags", "_raw_prefix", "_rest", "_parse_prefix",
+                 "_tag_cache")
+
     def __init__(self, tags=None, prefix=None, cmd=None, args=None):
-        self.tags = tags or {}
-        self.prefix = prefix
-        self.cmd = cmd
-        self.args = args or []
+        self._tags = tags or {}
+        self._prefix = prefix
+        self._cmd = cmd
+        self._args = args or []
+        self._raw_tags = self._raw_prefix = self._rest = None
+        self._tag_cache = None
+
+    # The fields of a parsed frame are only decoded (and the tags and prefix
+    # only parsed) when first accessed; until then the _raw_* slots and
+    # _rest hold slices of the original line.
+
+    @property
+    def tags(self):
+        if self._tags is _UNSET:
+            if self._raw_tags is not None:
+                self._tags = parse_tags(self._raw_tags.decode("utf-8", "replace"))
+            else:
+                self._tags = {}
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        self._tags = value
+
+    @property
+    def prefix(self):
+        if self._prefix is _UNSET:
+            prefix = self._raw_prefix
+            if prefix is not None:
+                prefix = prefix.decode("utf-8", "replace")
+                if self._parse_prefix:
+                    prefix = Prefix.parse(prefix)
+            self._prefix = prefix
+        return self._prefix
+
+    @prefix.setter
+    def prefix(self, value):
+        self._prefix = value
+
+    @property
+    def cmd(self):
+        if self._cmd is _UNSET:
+            cmd = self._rest.split(b" ", 1)[0]
+            self._cmd = _intern_cmd(cmd) if cmd else None
+        return self._cmd
+
+    @cmd.setter
+    def cmd(self, value):
+        self._cmd = value
+
+    @property
+    def args(self):
+        if self._args is _UNSET:
+            self._args = _split_params(self._rest.decode("utf-8", "replace"))
+        return self._args
+
+    @args.setter
+    def args(self, value):
+        self._args = value
+
+    @staticmethod
+    def scan(line, lone_prefix=False):
+        """
+        Find the tags, prefix and parameters of a raw IRC protocol line
+        without decoding it. Returns (tags, prefix, rest) as bytes slices,
+        where tags and prefix are None if absent, and rest holds the command
+        and its parameters.
+
+        A ":foo" token with nothing after it is a trailing parameter, unless
+        lone_prefix is set.
+        """
+
+        if not isinstance(line, memoryview):
+            # lines from LineBuffer are already stripped
+            line = line.rstrip(b"\r\n")
+        if lone_prefix:
+            return _LINE_LONE_PREFIX_RE.match(line).groups()
+        else:
+            return _LINE_RE.match(line).groups()
 
     @classmethod
     def split(cls, line):
@@ -101,37 +284,12 @@ class Frame(object):
         in RFC 1459 and the IRCv3 message-tags extension.
         """
 
-        line = line.decode("utf-8", "replace")
-        line = line.rstrip("\r\n").split(" ")
-        i, n = 0, len(line)
-        parv = []
-
-        while i < n and line[i] == "":
-            i += 1
-
-        if i < n and line[i].startswith("@"):
-            parv.append(line[i])
-            i += 1
-            while i < n and line[i] == "":
-                i += 1
-
-        if i + 1 < n and line[i].startswith(":"):
-            parv.append(line[i])
-            i += 1
-            while i < n and line[i] == "":
-                i += 1
-
-        while i < n:
-            if line[i].startswith(":"):
-                break
-            elif line[i] != "":
-                parv.append(line[i])
-            i += 1
-
-        if i < n:
-            trailing = " ".join(line[i:])
-            parv.append(trailing[1:])
-
+        tags, prefix, rest = cls.scan(line)
+        parv = _split_params(rest.decode("utf-8", "replace"))
+        if prefix is not None:
+            parv.insert(0, ":" + prefix.decode("utf-8", "replace"))
+        if tags is not None:
+            parv.insert(0, "@" + tags.decode("utf-8", "replace"))
         return parv
 
     @classmethod
@@ -139,53 +297,17 @@ class Frame(object):
         """
         Decode an IRC protocol line as UTF-8 and parse into a Frame object
         consisting of tags, prefix, command, and arguments.
-        """
-
-        line = line.decode("utf-8", "replace")
-        parv = line.rstrip("\r\n").split(" ")
-        i, n = 0, len(parv)
-        self = cls()
-
-        while i < n and parv[i] == "":
-            i += 1
-
-        if i < n and parv[i].startswith("@"):
-            tags = parv[i][1:]
-            i += 1
-            while i < n and parv[i] == "":
-                i += 1
-
-            self.tags = dict()
-            for item in tags.split(";"):
-                if "=" in item:
-                    k, v = item.split("=", 1)
-                else:
-                    k, v = item, True
-                self.tags[k] = v
-
-        if i < n and parv[i].startswith(":"):
-            prefix = parv[i][1:]
-            i += 1
-            while i < n and parv[i] == "":
-                i += 1
-
-            if parse_prefix:
-                self.prefix = Prefix.parse(prefix)
-            else:
-                self.prefix = prefix
-
-        if i < n:
-            self.cmd = parv[i].upper()
 
-        while i < n:
-            if parv[i].startswith(":"):
-                trailing = " ".join(parv[i:])
-                self.args.append(trailing[1:])
-                break
-            elif parv[i] != "":
-                self.args.append(parv[i])
-            i += 1
+        The line is scanned as bytes; each field is only decoded (and the
+        tags and prefix parsed) when the caller first accesses it.
+        """
 
+        self = cls.__new__(cls)
+        self._raw_tags, self._raw_prefix, self._rest = \
+            cls.scan(line, lone_prefix=True)
+        self._tags = self._prefix = self._cmd = self._args = _UNSET
+        self._parse_prefix = parse_prefix
+        self._tag_cache = None
         return self
 
     @classmethod
@@ -219,7 +341,7 @@ class Frame(object):
                 raise ValueError("Argument %d contains spaces: %r" % (i, argv[i]))
             i += 1
 
-        parv = argv[:i]
+        parv = list(argv[:i])
 
         if i < n:
             if not argv[i] or argv[i].startswith(":") or " " in argv[i]:
@@ -229,23 +351,172 @@ class Frame(object):
 
         return " ".join(parv).encode("utf-8") + b"\r\n"
 
+    def encode_tags(self):
+        """
+        Return the encoded tag block (without the leading "@") as bytes, or
+        None if the frame has no tags.
+
+        The encoding is cached, so relaying one frame to many clients only
+        encodes its tags once; if the tags were never accessed since parsing,
+        the original bytes are reused as they are.
+        """
+
+        if self._tags is _UNSET:
+            return self._raw_tags or None
+        elif not self._tags:
+            return None
+
+        cache = self._tag_cache
+        if cache is not None and cache[0] == self._tags:
+            return cache[1]
+
+        block = unparse_tags(self._tags).encode("utf-8")
+        self._tag_cache = (dict(self._tags), block)
+        return block
+
     def unparse(self):
         parv = []
 
-        if self.tags:
-            tags = [k if v is True else k + b"=" + v
-                    for k, v in self.tags.items()]
-            parv.append("@" + ";".join(tags))
-
         if self.prefix:
             parv.append(":" + str(self.prefix))
 
-        parv.append(self.cmd)
+        # parsed frames (those with _rest set) include the command as
+        # args[0], frames built by hand do not
+        if self._rest is None:
+            parv.append(self.cmd)
 
         parv.extend(self.args)
 
-        return self.join(parv)
+        line = self.join(parv)
+
+        tags = self.encode_tags()
+        if tags:
+            line = b"@" + tags + b" " + line
+
+        return line
 
     def __repr__(self):
         return "<IRC.Frame: tags=%r prefix=%r cmd=%r args=%r>" % \
                 (self.tags, self.prefix, self.cmd, self.args)
+
+class LineBuffer(object):
+    """
+    Split a stream of received data into IRC protocol lines.
+
+    Data is received into a fixed-size bytearray, either straight from a
+    socket with recv_into() or by feed(), and every complete line (ending
+    with LF or CR LF) is yielded as a memoryview into that buffer, without
+    the line terminator. Only the incomplete tail is ever moved, to the
+    start of the buffer when more data is received; this also means that
+    the views are only valid until then.
+
+    Lines over the length limits (checked separately for the tags and the
+    rest of the line) are discarded and counted in 'overlong'; empty lines
+    are skipped.
+    """
+
+    def __init__(self, size=65536, max_length=MAX_LINE_LENGTH,
+                 max_tags_length=MAX_TAGS_LENGTH):
+        if size <= max_length + max_tags_length:
+            raise ValueError("Buffer size %d too small for %d-byte lines"
+                             % (size, max_length + max_tags_length))
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.max_length = max_length
+        self.max_tags_length = max_tags_length
+        self.discarding = False
+        self.overlong = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _compact(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start > 0:
+            n = self.end - self.start
+            self.buf[:n] = self.buf[self.start:self.end]
+            self.start, self.end = 0, n
+
+    def recv_into(self, sock):
+        """
+        Receive as much as fits into the buffer with a single
+        sock.recv_into() call. Returns the number of bytes received (0 at
+        end of stream).
+        """
+
+        self._compact()
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        """
+        Add received data of any length, yielding the lines it completes.
+        The generator must be consumed for all of the data to be buffered.
+        """
+
+        data = memoryview(data)
+        while data:
+            self._compact()
+            n = min(len(data), len(self.buf) - self.end)
+            self.view[self.end:self.end+n] = data[:n]
+            self.end += n
+            data = data[n:]
+            yield from self.lines()
+
+    def lines(self):
+        """
+        Yield the complete lines currently in the buffer.
+        """
+
+        buf = self.buf
+        view = self.view
+        while True:
+            start = self.start
+            eol = buf.find(b"\n", start, self.end)
+            if eol < 0:
+                break
+            self.start = eol + 1
+
+            if self.discarding:
+                self.discarding = False
+                continue
+
+            stop = eol
+            if stop > start and buf[stop-1] == 0x0D:
+                stop -= 1
+            if stop == start:
+                continue
+
+            length = eol + 1 - start
+            if buf[start] == 0x40:
+                space = buf.find(b" ", start, stop)
+                tags_length = space + 1 - start if space >= 0 else length
+                length -= tags_length
+                if tags_length > self.max_tags_length:
+                    self.overlong += 1
+                    continue
+            if length > self.max_length:
+                self.overlong += 1
+                continue
+
+            yield view[start:stop]
+
+        if self.end - self.start >= self.max_length + self.max_tags_length:
+            # no line terminator within the limits; drop everything up to
+            # the next one
+            if not self.discarding:
+                self.overlong += 1
+            self.discarding = True
+            self.start = self.end
+
+    def frames(self, parse_prefix=True):
+        """
+        Yield the complete lines currently in the buffer as parsed Frames.
+        """
+
+        for line in self.lines():
+            yield Frame.parse(line, parse_prefix)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# Batch parser for raw IRC protocol logs
+#
+# Usage: irclog.py [-j JOBS] [-f csv|json] [-c CMD] [-n NICK] [-t TARGET] FILE...
+#
+# Each file is memory-mapped and split into line-aligned chunks, which are
+# parsed in a process pool. One row is output per message, with its
+# server-time timestamp, command, prefix nick and target, and the overall
+# throughput is reported on stderr.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+import mmap
+import os
+import sys
+import time
+
+import irc
+
+COLUMNS = ["time", "command", "nick", "target"]
+
+# commands whose first parameter is a channel or nick
+TARGET_COMMANDS = {"PRIVMSG", "NOTICE", "TAGMSG", "JOIN", "PART", "KICK",
+                   "MODE", "TOPIC", "INVITE"}
+
+# smallest chunk worth sending to a worker
+MIN_CHUNK_SIZE = 1 << 20
+
+def find_chunks(mm, count):
+    """
+    Split a mapped file into about 'count' chunks, each ending at a line
+    boundary. Returns a list of (start, end) offsets.
+    """
+
+    size = len(mm)
+    step = max(MIN_CHUNK_SIZE, size // max(count, 1) + 1)
+    chunks = []
+    start = 0
+    while start < size:
+        end = mm.find(b"\n", min(start + step, size) - 1)
+        end = size if end < 0 else end + 1
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+def parse_chunk(path, start, end, filters):
+    """
+    Parse the lines between two offsets of a file; return (rows, lines).
+    """
+
+    commands, nick, target = filters
+    rows = []
+    nlines = 0
+    with open(path, "rb") as fh, \
+         mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = line = memoryview(mm)
+        pos = start
+        while pos < end:
+            eol = mm.find(b"\n", pos, end)
+            if eol < 0:
+                eol = end
+            stop = eol
+            if stop > pos and mm[stop-1] == 0x0D:
+                stop -= 1
+            line = view[pos:stop]
+            pos = eol + 1
+            if not line:
+                continue
+            nlines += 1
+
+            frame = irc.Frame.parse(line)
+            if commands and frame.cmd not in commands:
+                continue
+            prefix = frame.prefix
+            m_nick = prefix.nick if prefix else None
+            if nick and (m_nick or "").lower() != nick:
+                continue
+            args = frame.args
+            if frame.cmd in TARGET_COMMANDS and len(args) > 1:
+                m_target = args[2] if frame.cmd == "INVITE" and len(args) > 2 \
+                           else args[1]
+            else:
+                m_target = None
+            if target and (m_target or "").lower() != target:
+                continue
+            rows.append((frame.tags.get("time"), frame.cmd, m_nick, m_target))
+        # the mmap cannot be closed while any view of it is alive
+        del line
+        view.release()
+    return rows, nlines
+
+def _parse_chunk(task):
+    return parse_chunk(*task)
+
+def make_tasks(paths, jobs, filters):
+    tasks = []
+    total = 0
+    for path in paths:
+        with open(path, "rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            if size == 0:
+                continue
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for start, end in find_chunks(mm, jobs * 4):
+                    tasks.append((path, start, end, filters))
+        total += size
+    return tasks, total
+
+def run_tasks(tasks, jobs):
+    """
+    Parse the chunks in a process pool, yielding (rows, lines) for each
+    chunk in order.
+    """
+
+    if jobs == 1 or len(tasks) <= 1:
+        yield from map(_parse_chunk, tasks)
+    else:
+        with ProcessPoolExecutor(jobs) as pool:
+            yield from pool.map(_parse_chunk, tasks)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+",
+                        help="raw IRC protocol logs, one message per line")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="number of worker processes")
+    parser.add_argument("-f", "--format", choices=["csv", "json"],
+                        default="csv",
+                        help="output format (CSV or JSON lines)")
+    parser.add_argument("-c", "--command", action="append",
+                        help="only output this command (can be repeated)")
+    parser.add_argument("-n", "--nick",
+                        help="only output messages from this nick")
+    parser.add_argument("-t", "--target",
+                        help="only output messages to this channel or nick")
+    args = parser.parse_args()
+
+    filters = ({c.upper() for c in args.command} if args.command else None,
+               args.nick.lower() if args.nick else None,
+               args.target.lower() if args.target else None)
+
+    out = sys.stdout
+    if args.format == "csv":
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(COLUMNS)
+        write = writer.writerows
+    else:
+        def write(rows):
+            out.writelines([json.dumps(dict(zip(COLUMNS, row))) + "\n"
+                            for row in rows])
+
+    t = time.perf_counter()
+    jobs = args.jobs or os.cpu_count() or 1
+    tasks, total = make_tasks(args.files, jobs, filters)
+    nlines = nrows = 0
+    for rows, lines in run_tasks(tasks, jobs):
+        write(rows)
+        nlines += lines
+        nrows += len(rows)
+    out.flush()
+    t = time.perf_counter() - t
+
+    print("%d lines, %d matched, %.1f MB in %.2f s (%.1f MB/s, %.0f lines/s)"
+          % (nlines, nrows, total / 1e6, t, total / 1e6 / t, nlines / t),
+          file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
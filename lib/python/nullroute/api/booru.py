@@ -1,14 +1,32 @@
 import bs4
-from collections import defaultdict
-from functools import lru_cache
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import email.message
+import email.utils
+import json
+from lxml.cssselect import CSSSelector
 import lxml.etree
 from nullroute.core import *
-from pprint import pprint
+import os
+import random
 import re
 import requests
+import sqlite3
+import threading
+import time
+import urllib.parse
 
 FAKE_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.84 Safari/537.36"
 
+# size of the chunks fed to the incremental parsers
+CHUNK_SIZE = 64 * 1024
+
+_LINK_SEL = CSSSelector("a", translator="html")
+_TAG_LINK_SEL = CSSSelector("a[itemprop='keywords']", translator="html")
+
+class PostNotFound(KeyError):
+    pass
+
 def _grep(pat, strings):
     pat = re.compile(pat)
     for string in strings:
@@ -31,13 +49,424 @@ def _strip_suffixes(arg, sfs):
             return arg[:-len(sf)]
     return arg
 
+def _iter_xml_posts(resp, convert):
+    """
+    Parse a streamed XML response incrementally, yielding convert(elem) for
+    each <post> child of the root element. Finished posts are cleared so
+    that memory use does not grow with the page size.
+    """
+
+    parser = lxml.etree.XMLPullParser(events=("end",), tag="post")
+    try:
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                parent = elem.getparent()
+                if parent is None or parent.getparent() is not None:
+                    continue
+                yield convert(elem)
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+        parser.close()
+    finally:
+        resp.close()
+
+def _get_charset(resp, default="utf-8"):
+    # resp.encoding cannot be used, as requests falls back to ISO-8859-1 for
+    # any text/* type without a charset
+    msg = email.message.Message()
+    msg["Content-Type"] = resp.headers.get("Content-Type", "")
+    return msg.get_param("charset") or default
+
+def _scrape_tag_sidebar(resp, post_id, link_sel=_LINK_SEL):
+    """
+    Parse a streamed post page up to the end of its ul#tag-sidebar and
+    return the tags as {kind: {tag, ...}}; the rest of the page is skipped.
+    """
+
+    parser = lxml.etree.HTMLPullParser(events=("end",), tag="ul",
+                                       encoding=_get_charset(resp))
+    sidebar = None
+    try:
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if elem.get("id") == "tag-sidebar":
+                    sidebar = elem
+                    break
+            if sidebar is not None:
+                break
+        else:
+            parser.close()
+    finally:
+        resp.close()
+    if sidebar is None:
+        # not necessarily a missing post (could be a login or challenge
+        # page, or a new layout), so this must not be cached
+        raise ValueError("no tag sidebar in page for post %r" % post_id)
+
+    tags = defaultdict(set)
+    for tag_li in sidebar.iterchildren("li"):
+        tag_type = _grep(r"^tag-type-(.+)", tag_li.get("class", "").split())
+        tag_value = "".join(link_sel(tag_li)[-1].itertext())
+        tags[tag_type].add(tag_value)
+    return tags
+
+# responses worth retrying, and those which mean "slow down"
+RETRY_STATUS = {429, 502, 503, 504}
+THROTTLE_STATUS = {429, 503}
+
+def _retry_after(resp):
+    """
+    Return the delay in seconds requested by a Retry-After header (either
+    seconds or an HTTP date), or None.
+    """
+
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+class TokenBucket(object):
+    """
+    Request rate limit for one host. The rate is halved whenever the host
+    throttles us and slowly grows back to max_rate as requests succeed.
+    """
+
+    def __init__(self, rate, burst, min_rate=0.1):
+        self.rate = self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.not_before = 0
+
+    def reserve(self):
+        """
+        Take a token; return how long to wait before making the request.
+        """
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        return max(wait, self.not_before - now)
+
+    def pause(self, delay):
+        self.not_before = max(self.not_before, time.monotonic() + delay)
+
+    def slow_down(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class RequestPolicy(object):
+    """
+    Shared rate limiting and retry logic: a token bucket per host, and
+    retries with exponential backoff (with jitter, or as long as the
+    Retry-After header asks) for connection errors and RETRY_STATUS
+    responses, up to max_attempts in total.
+    """
+
+    def __init__(self, rate=2.0, burst=4, max_attempts=5,
+                 backoff=1.0, max_backoff=60.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.buckets = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def _get_bucket(self, host):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[host] = bucket
+        return bucket
+
+    def _get_delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def request(self, session, url, **kwargs):
+        """
+        GET the URL through the session. Returns the response (the last one,
+        if all attempts were throttled) or raises the last connection error.
+        """
+
+        host = urllib.parse.urlsplit(url).netloc
+        for attempt in range(1, self.max_attempts + 1):
+            with self.lock:
+                bucket = self._get_bucket(host)
+                wait = bucket.reserve()
+                self.counters["requests"] += 1
+                if wait > 0:
+                    self.counters["delayed"] += 1
+                    self.counters["delay_time"] += wait
+            if wait > 0:
+                time.sleep(wait)
+
+            final = attempt == self.max_attempts
+            try:
+                resp = session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if final:
+                    with self.lock:
+                        self.counters["failed"] += 1
+                    raise
+                delay = self._get_delay(attempt)
+                Core.debug("%s: %s, retrying in %.1fs" % (host, e, delay))
+            else:
+                if resp.status_code not in RETRY_STATUS:
+                    with self.lock:
+                        bucket.speed_up()
+                    return resp
+                throttled = resp.status_code in THROTTLE_STATUS
+                with self.lock:
+                    if throttled:
+                        self.counters["throttled"] += 1
+                        bucket.slow_down()
+                    if final:
+                        self.counters["failed"] += 1
+                if final:
+                    return resp
+                delay = max(self._get_delay(attempt), _retry_after(resp) or 0)
+                Core.debug("%s: error %r, retrying in %.1fs (rate %.2f/s)"
+                           % (host, resp.status_code, delay, bucket.rate))
+                resp.close()
+            # the whole host waits, not only this request
+            with self.lock:
+                bucket.pause(delay)
+                self.counters["retried"] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters,
+                        rates={host: bucket.rate
+                               for host, bucket in self.buckets.items()})
+
+def default_cache_path():
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or \
+                os.path.expanduser("~/.cache")
+    return os.path.join(cache_dir, "nullroute", "booru.sqlite")
+
+class PostCache(object):
+    """
+    Post metadata kept in SQLite, keyed by site and "id:<id>" or "md5:<md5>".
+
+    A stored value of None means the post was not found; such entries
+    expire after 'negative_ttl' instead of 'ttl'. Once the cache grows past
+    'max_entries', the least recently used entries are dropped.
+    """
+
+    # how often (in stores) to check the size limit
+    EVICT_INTERVAL = 256
+
+    def __init__(self, path=None, ttl=7*86400, negative_ttl=86400,
+                 max_entries=100000):
+        self.path = path or default_cache_path()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.stores = 0
+        self.lock = threading.Lock()
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=30,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS posts ("
+                            " site TEXT, key TEXT, value TEXT,"
+                            " stored REAL, used REAL,"
+                            " PRIMARY KEY (site, key))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS posts_used"
+                            " ON posts (used)")
+        self.evict()
+
+    def get(self, site, key):
+        """
+        Return (hit, value); value is None for a cached 'not found'.
+        """
+
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT value, stored FROM posts"
+                                  " WHERE site = ? AND key = ?",
+                                  (site, key)).fetchone()
+            if row is None:
+                return False, None
+            value, stored = row
+            ttl = self.ttl if value is not None else self.negative_ttl
+            if stored + ttl < now:
+                return False, None
+            self.db.execute("UPDATE posts SET used = ?"
+                            " WHERE site = ? AND key = ?",
+                            (now, site, key))
+        return True, (json.loads(value) if value is not None else None)
+
+    def put(self, site, key, value):
+        """
+        Store a value (sets are stored as sorted lists); returns it as it
+        will be read back.
+        """
+
+        data = json.dumps(value, default=sorted) if value is not None else None
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO posts"
+                            " (site, key, value, stored, used)"
+                            " VALUES (?, ?, ?, ?, ?)",
+                            (site, key, data, now, now))
+            self.stores += 1
+        if self.stores % self.EVICT_INTERVAL == 0:
+            self.evict()
+        return json.loads(data) if data is not None else None
+
+    def evict(self):
+        now = time.time()
+        with self.lock:
+            self.db.execute("DELETE FROM posts WHERE"
+                            " (value IS NOT NULL AND stored < ?) OR"
+                            " (value IS NULL AND stored < ?)",
+                            (now - self.ttl, now - self.negative_ttl))
+            count, = self.db.execute("SELECT COUNT(*) FROM posts").fetchone()
+            if count > self.max_entries:
+                self.db.execute("DELETE FROM posts WHERE rowid IN"
+                                " (SELECT rowid FROM posts"
+                                "  ORDER BY used LIMIT ?)",
+                                (count - self.max_entries,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_default_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PostCache()
+        return _default_cache
+
 class BooruApi(object):
     NAME_RE = []
     URL_RE = []
-
-    def __init__(self, tag_filter=None):
+    # site name in the post cache (defaults to the class name)
+    CACHE_NAME = None
+
+    # maximum number of concurrent requests to the site
+    MAX_CONNECTIONS = 4
+    # posts per page requested by iter_posts()
+    PAGE_SIZE = 100
+    # requests per second to each host, and attempts per request
+    REQUEST_RATE = 2.0
+    REQUEST_BURST = 4
+    MAX_ATTEMPTS = 5
+
+    _site_slots = {}
+    _site_slots_lock = threading.Lock()
+    _policies = {}
+
+    def __init__(self, tag_filter=None, cache=None):
         self.tag_filter = tag_filter
+        self.cache = cache or get_default_cache()
+        self.cache_site = self.CACHE_NAME or type(self).__name__
+        self.policy = self._get_policy()
         self.ua = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.MAX_CONNECTIONS)
+        self.ua.mount("http://", adapter)
+        self.ua.mount("https://", adapter)
+
+    def _get_site_slots(self):
+        # shared by all instances for the same site
+        cls = type(self)
+        with BooruApi._site_slots_lock:
+            slots = BooruApi._site_slots.get(cls)
+            if slots is None:
+                slots = threading.BoundedSemaphore(cls.MAX_CONNECTIONS)
+                BooruApi._site_slots[cls] = slots
+            return slots
+
+    def _get_policy(self):
+        # likewise shared, so that all instances see the same rate limits
+        cls = type(self)
+        with BooruApi._site_slots_lock:
+            policy = BooruApi._policies.get(cls)
+            if policy is None:
+                policy = RequestPolicy(rate=cls.REQUEST_RATE,
+                                       burst=cls.REQUEST_BURST,
+                                       max_attempts=cls.MAX_ATTEMPTS)
+                BooruApi._policies[cls] = policy
+            return policy
+
+    def _get(self, url, **kwargs):
+        return self.policy.request(self.ua, url, **kwargs)
+
+    def _map_many(self, func, items, jobs=None):
+        """
+        Call func(item) for each item in a thread pool, with at most
+        MAX_CONNECTIONS requests to the site running at once.
+
+        Yields (item, result, error) in the order of the input, where error
+        is the exception raised for that item (and result is None); a
+        failed item does not stop the rest of the batch.
+        """
+
+        items = list(items)
+        slots = self._get_site_slots()
+
+        def call(item):
+            with slots:
+                return func(item)
+
+        jobs = min(jobs or self.MAX_CONNECTIONS, self.MAX_CONNECTIONS)
+        pool = ThreadPoolExecutor(jobs)
+        try:
+            futures = [pool.submit(call, item) for item in items]
+            for item, future in zip(items, futures):
+                try:
+                    yield item, future.result(), None
+                except Exception as e:
+                    yield item, None, e
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _cached(self, key, fetch):
+        """
+        Return the cached value for key, or call fetch() and store its
+        result. A 404 error or PostNotFound from fetch() (or a None result)
+        is cached as 'not found' and None is returned.
+        """
+
+        hit, value = self.cache.get(self.cache_site, key)
+        if hit:
+            return value
+        try:
+            value = fetch()
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            value = None
+        except PostNotFound:
+            value = None
+        return self.cache.put(self.cache_site, key, value)
 
     def match_file_name(self, name):
         for pat in self.NAME_RE:
@@ -54,18 +483,83 @@ class BooruApi(object):
     def find_posts(self, tags, page=1, limit=100):
         raise NotImplementedError
 
+    def iter_posts(self, tags, limit=None, page_size=None):
+        """
+        Yield posts from consecutive result pages, fetching the next page in
+        the background while the current one is consumed.
+
+        Stops after 'limit' posts, at an empty page, or at a page containing
+        only posts already seen (pages overlap when new uploads shift the
+        results while paging).
+        """
+
+        page_size = min(page_size or self.PAGE_SIZE, limit or self.PAGE_SIZE)
+        slots = self._get_site_slots()
+
+        def fetch(page):
+            with slots:
+                return list(self.find_posts(tags, page=page, limit=page_size))
+
+        seen = set()
+        page = 1
+        pool = ThreadPoolExecutor(1)
+        try:
+            future = pool.submit(fetch, page)
+            while future:
+                posts = future.result()
+                page += 1
+                # no point in prefetching if this page will reach the limit
+                if posts and not (limit and len(seen) + len(posts) >= limit):
+                    future = pool.submit(fetch, page)
+                else:
+                    future = None
+                new = 0
+                for post in posts:
+                    if post["id"] in seen:
+                        continue
+                    seen.add(post["id"])
+                    new += 1
+                    yield post
+                    if limit and len(seen) >= limit:
+                        return
+                if not new:
+                    break
+                if not future:
+                    # duplicates left us short of the limit
+                    future = pool.submit(fetch, page)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
     def find_posts_by_md5(self, md5):
-        yield from self.find_posts("md5:%s" % md5)
+        posts = self._cached("md5:%s" % md5,
+                             lambda: list(self.find_posts("md5:%s" % md5)) or None)
+        yield from posts or []
+
+    def find_posts_by_md5_many(self, md5s, jobs=None):
+        """
+        Look up many hashes concurrently; yields (md5, [posts], error).
+        """
+
+        yield from self._map_many(lambda md5: list(self.find_posts_by_md5(md5)),
+                                  md5s, jobs)
 
     def get_post_tags(self, post_id):
         raise NotImplementedError
 
+    def get_tags_many(self, post_ids, jobs=None):
+        """
+        Fetch the tags of many posts concurrently; yields (post_id, tags,
+        error).
+        """
+
+        yield from self._map_many(self.get_post_tags, post_ids, jobs)
+
     def sort_tags(self, raw_tags):
         all_tags = []
         for key in ("artist", "copyright", "character"):
-            val = [t.replace(" ", "_") for t in raw_tags[key]]
+            val = [t.replace(" ", "_") for t in raw_tags.get(key, [])]
             if key == "character" and len(val) <= 2:
-                bad_suffixes = ["_(%s)" % s for s in raw_tags["copyright"]]
+                bad_suffixes = ["_(%s)" % s for s in raw_tags.get("copyright", [])]
                 val = [_strip_suffixes(t, bad_suffixes) for t in val]
             all_tags += sorted(val)
         if self.tag_filter:
@@ -82,8 +576,7 @@ class DanbooruApi(BooruApi):
     ]
     ID_PREFIX = "db%s"
     HASH_SUFFIX = True
-
-    _cache = {}
+    CACHE_NAME = "danbooru"
 
     def find_posts(self, tags, page=1, limit=100):
         ep = "/posts.xml"
@@ -91,34 +584,28 @@ class DanbooruApi(BooruApi):
                 "page": page,
                 "limit": limit}
 
-        resp = self.ua.get(self.SITE_URL + ep, params=args)
+        resp = self._get(self.SITE_URL + ep, params=args, stream=True)
         resp.raise_for_status()
 
-        tree = lxml.etree.XML(resp.content)
-        for item in tree.xpath("/posts/post"):
-            attrib = {child.tag.replace("-", "_"): child.text
-                      for child in item.iterchildren()}
-            attrib = {"tags": {}}
-            for child in item.iterchildren():
-                key = child.tag.replace("-", "_")
-                val = child.text
-                attrib[key] = val
-                if key.startswith("tag_string_"):
-                    kind = _strip_prefix(key, "tag_string_")
-                    attrib["tags"][kind] = val.split() if val else []
-            pprint(attrib)
-            self._cache["id:%(id)s" % attrib] = attrib
-            yield attrib
+        for attrib in _iter_xml_posts(resp, self._parse_post):
+            yield self.cache.put(self.cache_site, "id:%(id)s" % attrib, attrib)
+
+    def _parse_post(self, item):
+        attrib = {"tags": {}}
+        for child in item.iterchildren():
+            key = child.tag.replace("-", "_")
+            val = child.text
+            attrib[key] = val
+            if key.startswith("tag_string_"):
+                kind = _strip_prefix(key, "tag_string_")
+                attrib["tags"][kind] = val.split() if val else []
+        return attrib
 
     def get_post_tags(self, post_id):
         key = "id:%s" % post_id
-        post = self._cache.get(key)
+        post = self._cached(key, lambda: next(self.find_posts(key), None))
         if not post:
-            posts = self.find_posts(key)
-            try:
-                post = next(posts)
-            except StopIteration:
-                raise KeyError("post %r not found" % key)
+            raise PostNotFound("post %r not found" % key)
         return post["tags"]
 
 ## Gelbooru
@@ -127,44 +614,37 @@ class GelbooruApi(BooruApi):
     API_ROOT = "http://gelbooru.com/index.php"
     ID_PREFIX = "g%s"
     TAG_SCRAPE = True
+    CACHE_NAME = "gelbooru"
 
-    def find_posts(self, tags, limit=100):
+    def find_posts(self, tags, page=1, limit=100):
         args = {"page": "dapi",
                 "s": "post",
                 "q": "index",
                 "tags": tags,
+                "pid": page - 1,
                 "limit": limit}
 
-        resp = self.ua.get(self.API_ROOT, params=args)
+        resp = self._get(self.API_ROOT, params=args, stream=True)
         resp.raise_for_status()
 
-        tree = lxml.etree.XML(resp.content)
-        for item in tree.xpath("/posts/post"):
-            yield dict(item.attrib)
+        yield from _iter_xml_posts(resp, lambda item: dict(item.attrib))
 
     def _scrape_post_info(self, post_id):
         args = {"page": "post",
                 "s": "view",
                 "id": post_id}
 
-        resp = self.ua.get(self.API_ROOT, params=args)
+        resp = self._get(self.API_ROOT, params=args, stream=True)
         resp.raise_for_status()
 
-        page = bs4.BeautifulSoup(resp.content, "lxml")
-        sidebar = page.select_one("ul#tag-sidebar")
-
-        post = {"id": post_id,
-                "tags": defaultdict(set)}
-
-        for tag_li in sidebar.find_all("li"):
-            tag_type = _grep(r"^tag-type-(.+)", tag_li["class"])
-            tag_value = tag_li.find_all("a")[-1].get_text()
-            post["tags"][tag_type].add(tag_value)
-
-        return post
+        return {"id": post_id,
+                "tags": _scrape_tag_sidebar(resp, post_id)}
 
     def get_post_tags(self, post_id):
-        info = self._scrape_post_info(post_id)
+        info = self._cached("id:%s" % post_id,
+                            lambda: self._scrape_post_info(post_id))
+        if not info:
+            raise PostNotFound("post %r not found" % post_id)
         return info["tags"]
 
 ## Sankaku Complex
@@ -177,64 +657,48 @@ class SankakuApi(BooruApi):
         re.compile(r"^https://cs\.sankakucomplex\.com/data/\w+/\w+/(?P<md5>\w+)\.\w+\?(?P<id>\d+)"),
     ]
     ID_PREFIX = "san%s"
+    CACHE_NAME = "sankaku"
+    # answers 503 as soon as it sees a few parallel requests
+    MAX_CONNECTIONS = 2
+    PAGE_SIZE = 20
+    REQUEST_RATE = 1.0
+    MAX_ATTEMPTS = 8
 
     def _fetch_url(self, *args, **kwargs):
         headers = kwargs.setdefault("headers", {})
         headers["User-Agent"] = FAKE_UA
-        while True:
-            resp = self.ua.get(*args, **kwargs)
-            Core.debug("fetched %r" % resp.url)
-            if resp.status_code == 503:
-                Core.debug("error %r, retrying in 1s" % resp.status_code)
-                time.sleep(1)
-            else:
-                resp.raise_for_status()
-                return resp
-
-    def find_posts(self, query, limit=20):
-        # API has been blocked a long time ago; resort to scraping
-        post_ids = []
-        next_url = True
-        page = 1
-
-        while next_url:
-            Core.debug("scraping %r (page %d)" % (query, page))
-            args = {"tags": query,
-                    "page": page}
-            resp = self._fetch_url(self.SITE_URL, params=args)
-            body = bs4.BeautifulSoup(resp.content, "lxml")
-            div = body.select_one("div.content div")
-            post_ids = []
-            for span in div.find_all("span", {"id": True}):
-                post_id = span["id"].lstrip("p")
-                post_ids.append(post_id)
-                if len(post_ids) >= limit:
-                    break
-            next_url = body.get("next-page-url")
-            page += 1
-
-        for post_id in post_ids:
-            yield {"id": post_id}
+        resp = self._get(*args, **kwargs)
+        Core.debug("fetched %r" % resp.url)
+        resp.raise_for_status()
+        return resp
+
+    def find_posts(self, query, page=1, limit=20):
+        # API has been blocked a long time ago; resort to scraping.
+        # The site always returns 20 posts per page, so limit can only
+        # shorten it; use iter_posts() to go through several pages.
+        Core.debug("scraping %r (page %d)" % (query, page))
+        args = {"tags": query,
+                "page": page}
+        resp = self._fetch_url(self.SITE_URL, params=args)
+        body = bs4.BeautifulSoup(resp.content, "lxml")
+        div = body.select_one("div.content div")
+        if div is None:
+            return
+        for span in div.find_all("span", {"id": True})[:limit]:
+            yield {"id": span["id"].lstrip("p")}
 
     def _scrape_post_info(self, post_id):
-        resp = self._fetch_url(self.POST_URL % post_id)
+        resp = self._fetch_url(self.POST_URL % post_id, stream=True)
         resp.raise_for_status()
 
-        page = bs4.BeautifulSoup(resp.content, "lxml")
-        sidebar = page.select_one("ul#tag-sidebar")
-
-        post = {"id": post_id,
-                "tags": defaultdict(set)}
-
-        for tag_li in sidebar.find_all("li"):
-            tag_type = _grep(r"^tag-type-(.+)", tag_li["class"])
-            tag_value = tag_li.select_one("a[itemprop='keywords']").get_text()
-            post["tags"][tag_type].add(tag_value)
-
-        return post
+        return {"id": post_id,
+                "tags": _scrape_tag_sidebar(resp, post_id, _TAG_LINK_SEL)}
 
     def get_post_tags(self, post_id):
-        info = self._scrape_post_info(post_id)
+        info = self._cached("id:%s" % post_id,
+                            lambda: self._scrape_post_info(post_id))
+        if not info:
+            raise PostNotFound("post %r not found" % post_id)
         return info["tags"]
 
 ## Yande.re
@@ -248,6 +712,7 @@ class YandereApi(BooruApi):
     ]
     ID_PREFIX = "yande.re %s"
     HASH_SUFFIX = False
+    CACHE_NAME = "yandere"
 
     def find_posts(self, tags, page=1, limit=100):
         ep = "/post.xml"
@@ -255,35 +720,21 @@ class YandereApi(BooruApi):
                 "page": page,
                 "limit": limit}
 
-        resp = self.ua.get(self.SITE_URL + ep, params=args)
-        resp.raise_for_status()
-
-        tree = lxml.etree.XML(resp.content)
-        for item in tree.xpath("/posts/post"):
-            yield dict(item.attrib)
-
-    @lru_cache(maxsize=1024)
-    def _fetch_post_page(self, post_id):
-        resp = self.ua.get(self.POST_URL % post_id)
+        resp = self._get(self.SITE_URL + ep, params=args, stream=True)
         resp.raise_for_status()
 
-        page = bs4.BeautifulSoup(resp.content, "lxml")
-        return page
+        yield from _iter_xml_posts(resp, lambda item: dict(item.attrib))
 
     def _scrape_post_info(self, post_id):
-        page = self._fetch_post_page(post_id)
-        sidebar = page.select_one("ul#tag-sidebar")
-
-        post = {"id": post_id,
-                "tags": defaultdict(set)}
-
-        for tag_li in sidebar.find_all("li"):
-            tag_type = _grep(r"^tag-type-(.+)", tag_li["class"])
-            tag_value = tag_li.find_all("a")[-1].get_text()
-            post["tags"][tag_type].add(tag_value)
+        resp = self._get(self.POST_URL % post_id, stream=True)
+        resp.raise_for_status()
 
-        return post
+        return {"id": post_id,
+                "tags": _scrape_tag_sidebar(resp, post_id)}
 
     def get_post_tags(self, post_id):
-        info = self._scrape_post_info(post_id)
+        info = self._cached("id:%s" % post_id,
+                            lambda: self._scrape_post_info(post_id))
+        if not info:
+            raise PostNotFound("post %r not found" % post_id)
         return info["tags"]
@@ -15,7 +15,11 @@
 
 from __future__ import print_function
 import base64
+import binascii
+from collections import deque
+import hashlib
 from io import BytesIO
+import re
 
 ALPHA           = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
 DIGITS          = b"0123456789"
@@ -41,6 +45,85 @@ ESCAPE_CHARS = {
     b"\\":  b"\\",
 }
 
+# Per-byte lookup tables, so that the scanners can classify a character
+# with a single index instead of searching the strings above.
+
+CLASS_WHITESPACE    = 0x01
+CLASS_DIGIT         = 0x02
+CLASS_TOKEN         = 0x04
+CLASS_HEX           = 0x08
+CLASS_BASE64        = 0x10
+
+def _make_class_table():
+    table = bytearray(256)
+    for chars, flag in [(WHITESPACE, CLASS_WHITESPACE),
+                        (DIGITS, CLASS_DIGIT),
+                        (TOKEN_CHARS, CLASS_TOKEN),
+                        (HEX_DIGITS, CLASS_HEX),
+                        (B64_DIGITS[:-1], CLASS_BASE64)]:
+        for c in chars:
+            table[c] |= flag
+    return bytes(table)
+
+def _make_value_table(*alphabets):
+    table = [-1] * 256
+    for digits in alphabets:
+        for value, c in enumerate(digits):
+            table[c] = value
+    return table
+
+CHAR_CLASS      = _make_class_table()
+HEX_VALUE       = _make_value_table(b"0123456789abcdef", b"0123456789ABCDEF")
+B64_VALUE       = _make_value_table(B64_DIGITS[:-1])
+
+QUOTEABLE_CHARS = bytes(sorted(set(PRINTABLE_CHARS + b"".join(ESCAPE_CHARS))
+                               - set(VERBATIM)))
+
+_WHITESPACE_RE  = re.compile(rb"[ \t\v\f\r\n]*")
+_TOKEN_RE       = re.compile(rb"[0-9A-Za-z\-./_:*+=]+")
+_DECIMAL_RE     = re.compile(rb"[0-9]+")
+_QUOTED_RE      = re.compile(rb'[^"\\]*')
+
+_VERBATIM_RE    = re.compile(rb"([0-9]+):")
+_QUOTE_RE       = re.compile(rb'[\b\t\v\n\f\r\\\'"]')
+
+def _quote_char(m):
+    char = m.group()
+    return b"\\" + ESCAPE_CHARS.get(char, char)
+
+_QUOTED_ESCAPES = {
+    ord("b"):   b"\b",
+    ord("f"):   b"\f",
+    ord("n"):   b"\n",
+    ord("r"):   b"\r",
+    ord("t"):   b"\t",
+    ord("v"):   b"\v",
+    ord("\\"):  b"\\",
+    ord("'"):   b"'",
+    ord('"'):   b'"',
+}
+
+def _decode_hex(digits, pos):
+    """Decode a complete hex region (whitespace already removed)."""
+    if len(digits) % 2:
+        raise IOError("4-bit region ended with unused bits at %d" % pos)
+    try:
+        return binascii.unhexlify(digits)
+    except (binascii.Error, ValueError):
+        raise IOError("invalid 4-bit region at %d" % pos)
+
+def _decode_base64(digits, pos):
+    """Decode a complete base64 region (whitespace already removed),
+    tolerating missing padding."""
+    digits = digits.rstrip(b"=")
+    if len(digits) % 4 == 1:
+        raise IOError("6-bit region ended with unused bits at %d" % pos)
+    digits += b"=" * (-len(digits) % 4)
+    try:
+        return base64.b64decode(digits, validate=True)
+    except (binascii.Error, ValueError):
+        raise IOError("invalid 6-bit region at %d" % pos)
+
 class SexpParser(object):
     def __init__(self, buf):
         self.bytesize = 8
@@ -89,7 +172,7 @@ class SexpParser(object):
                         (self.bytesize, self.nBits, self.pos))
                 self.bytesize = 8
                 return self.char
-            elif self.bytesize != 8 and self.char in WHITESPACE:
+            elif self.bytesize != 8 and CHAR_CLASS[self.char[0]] & CLASS_WHITESPACE:
                 # ignore whitespace in hex/base64 regions
                 pass
             elif self.bytesize == 6 and self.char == b"=":
@@ -98,15 +181,15 @@ class SexpParser(object):
             elif self.bytesize == 8:
                 return self.char
             elif self.bytesize < 8:
-                self.bits <<= self.bytesize
-                self.nBits += self.bytesize
-                if self.bytesize == 6 and self.char in B64_DIGITS:
-                    self.bits |= B64_DIGITS.index(self.char)
-                elif self.bytesize == 4 and self.char in HEX_DIGITS:
-                    self.bits |= int(self.char, 16)
+                if self.bytesize == 6:
+                    value = B64_VALUE[self.char[0]]
                 else:
+                    value = HEX_VALUE[self.char[0]]
+                if value < 0:
                     raise IOError("char %r found in %d-bit region" %
                         (self.char, self.bytesize))
+                self.bits = (self.bits << self.bytesize) | value
+                self.nBits += self.bytesize
 
                 if self.nBits >= 8:
                     self.nBits -= 8
@@ -117,7 +200,7 @@ class SexpParser(object):
 
     def skip_whitespace(self):
         while self.char:
-            if self.char in WHITESPACE:
+            if CHAR_CLASS[self.char[0]] & CLASS_WHITESPACE:
                 self.advance()
             elif self.char == b";" and self.last in b"\r\n":
                 while self.char and self.char not in b"\r\n":
@@ -139,16 +222,15 @@ class SexpParser(object):
 
     def scan_token(self):
         self.skip_whitespace()
-        out = b""
-        while self.char and self.char in TOKEN_CHARS:
+        out = bytearray()
+        while self.char and CHAR_CLASS[self.char[0]] & CLASS_TOKEN:
             out += self.char
             self.advance()
-        #print("scan_simple_string ->", repr(out))
-        return out
+        return bytes(out)
 
     def scan_decimal(self):
         i, value = 0, 0
-        while self.char and self.char in DIGITS:
+        while self.char and CHAR_CLASS[self.char[0]] & CLASS_DIGIT:
             value = value*10 + int(self.char)
             i += 1
             if i > 8:
@@ -162,12 +244,18 @@ class SexpParser(object):
         self.skip_char(b":")
         if not length:
             raise ValueError("verbatim string had no length")
-        out, i = b"", 0
-        while i < length:
+        if self.bytesize == 8:
+            # outside a transport region, the rest can be read in bulk
+            out = self.char + self.buf.read(length - 1)
+            if len(out) < length:
+                raise IOError("EOF found inside %d-byte verbatim string" % length)
+            self.advance()
+            return out
+        out = bytearray()
+        while len(out) < length:
             out += self.char
             self.advance()
-            i += 1
-        return out
+        return bytes(out)
 
     def scan_quoted_string(self, length=None):
         self.skip_char(b"\"")
@@ -209,10 +297,11 @@ class SexpParser(object):
     def scan_hex_string(self, length=None):
         self.bytesize = 4
         self.skip_char(b"#")
-        out = b""
+        out = bytearray()
         while self.char and (self.char != b"#" or self.bytesize == 4):
             out += self.char
             self.advance()
+        out = bytes(out)
         self.skip_char(b"#")
         if length and length != len(out):
             raise ValueError("hexstring length %d != declared length %d" %
@@ -222,10 +311,11 @@ class SexpParser(object):
     def scan_base64_string(self, length=None):
         self.bytesize = 6
         self.skip_char(b"|")
-        out = b""
+        out = bytearray()
         while self.char and (self.char != b"|" or self.bytesize == 6):
             out += self.char
             self.advance()
+        out = bytes(out)
         self.skip_char(b"|")
         if length and length != len(out):
             raise ValueError("base64 length %d != declared length %d" %
@@ -236,10 +326,11 @@ class SexpParser(object):
         self.skip_whitespace()
         if not self.char:
             return None
-        elif self.char in TOKEN_CHARS and self.char not in DIGITS:
+        cls = CHAR_CLASS[self.char[0]]
+        if cls & CLASS_TOKEN and not cls & CLASS_DIGIT:
             return self.scan_token()
-        elif self.char in DIGITS or self.char in b"\"#|:":
-            if self.char in DIGITS:
+        elif cls & CLASS_DIGIT or self.char in b"\"#|:":
+            if cls & CLASS_DIGIT:
                 length = self.scan_decimal()
             else:
                 length = None
@@ -297,8 +388,682 @@ class SexpParser(object):
             out = self.scan_string()
         return out
 
+class SexpBufferParser(object):
+    """Parse S-expressions from a complete in-memory buffer.
+
+    Unlike SexpParser, which pulls one byte at a time from a file object,
+    this works over the whole buffer with an integer cursor and extracts
+    tokens, strings and hex/base64 regions by slicing.
+    """
+
+    def __init__(self, buf):
+        if hasattr(buf, "read"):
+            buf = buf.read()
+        self.buf = bytes(buf)
+        self.pos = 0
+        self.end = len(self.buf)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        obj = self.scan_object()
+        if obj is None:
+            raise StopIteration
+        return obj
+
+    def skip_whitespace(self):
+        buf, end = self.buf, self.end
+        while True:
+            pos = _WHITESPACE_RE.match(buf, self.pos).end()
+            if pos < end and buf[pos] == 0x3B \
+                    and (pos == 0 or buf[pos-1] in b"\r\n"):
+                # ';' at the beginning of a line starts a comment
+                eol = buf.find(b"\n", pos)
+                self.pos = end if eol < 0 else eol + 1
+            else:
+                self.pos = pos
+                return
+
+    def skip_char(self, char):
+        """Skip the next character if it matches expectations."""
+        if self.pos >= self.end:
+            raise IOError("EOF found where %r expected" % char)
+        elif self.buf[self.pos] == ord(char):
+            self.pos += 1
+        else:
+            raise IOError("char %r found where %r expected at %d" % (
+                self.buf[self.pos:self.pos+1], char, self.pos))
+
+    def find_char(self, char, what):
+        pos = self.buf.find(char, self.pos)
+        if pos < 0:
+            raise IOError("%s starting at %d is missing closing %r" % (
+                what, self.pos, char))
+        return pos
+
+    def scan_token(self):
+        m = _TOKEN_RE.match(self.buf, self.pos)
+        self.pos = m.end()
+        return m.group()
+
+    def scan_decimal(self):
+        m = _DECIMAL_RE.match(self.buf, self.pos)
+        if m.end() - self.pos > 8:
+            raise IOError("decimal %s... too long" % m.group()[:8].decode())
+        self.pos = m.end()
+        return int(m.group())
+
+    def scan_verbatim_string(self, length=None):
+        """Return the value of verbatim string with given length."""
+        self.skip_whitespace()
+        self.skip_char(":")
+        if length is None:
+            raise ValueError("verbatim string had no length")
+        start, self.pos = self.pos, self.pos + length
+        if self.pos > self.end:
+            raise IOError("EOF found inside %d-byte verbatim string at %d" % (
+                length, start))
+        return self.buf[start:self.pos]
+
+    def scan_quoted_string(self, length=None):
+        self.skip_char('"')
+        buf, end = self.buf, self.end
+        out = []
+        while True:
+            m = _QUOTED_RE.match(buf, self.pos)
+            out.append(m.group())
+            self.pos = m.end()
+            if self.pos >= end:
+                raise ValueError("quoted string is missing closing quote")
+            elif buf[self.pos] == 0x22:
+                self.pos += 1
+                break
+            # backslash escape
+            self.pos += 2
+            if self.pos > end:
+                raise ValueError("quoted string is missing closing quote")
+            c = buf[self.pos-1]
+            if c in _QUOTED_ESCAPES:
+                out.append(_QUOTED_ESCAPES[c])
+            elif c in b"\r\n":
+                # line continuation, possibly a two-character one
+                if buf[self.pos:self.pos+1] in (b"\r", b"\n") \
+                        and buf[self.pos] != c:
+                    self.pos += 1
+            elif c in b"0123":
+                s = buf[self.pos-1:self.pos+2]
+                self.pos += 2
+                out.append(bytes([int(s, 8)]))
+            elif c == 0x78:
+                s = buf[self.pos:self.pos+2]
+                self.pos += 2
+                out.append(bytes([int(s, 16)]))
+            else:
+                raise ValueError("unknown escape character \\%s at %d" % (
+                    chr(c), self.pos))
+        out = b"".join(out)
+        if length is not None and length != len(out):
+            raise ValueError("quoted string length %d != declared length %d" %
+                (len(out), length))
+        return out
+
+    def scan_hex_string(self, length=None):
+        self.skip_char("#")
+        stop = self.find_char(b"#", "hex string")
+        region = self.buf[self.pos:stop].translate(None, WHITESPACE)
+        out = _decode_hex(region, self.pos)
+        self.pos = stop + 1
+        if length is not None and length != len(out):
+            raise ValueError("hexstring length %d != declared length %d" %
+                (len(out), length))
+        return out
+
+    def scan_base64_region(self, stop):
+        region = self.buf[self.pos:stop].translate(None, WHITESPACE)
+        return _decode_base64(region, self.pos)
+
+    def scan_base64_string(self, length=None):
+        self.skip_char("|")
+        stop = self.find_char(b"|", "base64 string")
+        out = self.scan_base64_region(stop)
+        self.pos = stop + 1
+        if length is not None and length != len(out):
+            raise ValueError("base64 length %d != declared length %d" %
+                (len(out), length))
+        return out
+
+    def scan_simple_string(self):
+        self.skip_whitespace()
+        if self.pos >= self.end:
+            return None
+        c = self.buf[self.pos]
+        cls = CHAR_CLASS[c]
+        if cls & CLASS_TOKEN and not cls & CLASS_DIGIT:
+            return self.scan_token()
+        elif cls & CLASS_DIGIT or c in b"\"#|:":
+            if cls & CLASS_DIGIT:
+                length = self.scan_decimal()
+                c = self.buf[self.pos] if self.pos < self.end else None
+            else:
+                length = None
+            if c == 0x22:
+                return self.scan_quoted_string(length)
+            elif c == 0x23:
+                return self.scan_hex_string(length)
+            elif c == 0x7C:
+                return self.scan_base64_string(length)
+            elif c == 0x3A:
+                return self.scan_verbatim_string(length)
+            elif c is None:
+                raise IOError("EOF found after length prefix")
+            else:
+                raise ValueError("illegal char %r at %d" % (chr(c), self.pos))
+        else:
+            raise ValueError("illegal char %r at %d" % (chr(c), self.pos))
+
+    def scan_string(self):
+        hint = None
+        if self.buf[self.pos] == 0x5B:
+            self.skip_char("[")
+            hint = self.scan_simple_string()
+            self.skip_whitespace()
+            self.skip_char("]")
+            self.skip_whitespace()
+        out = self.scan_simple_string()
+        return (hint, out) if hint else out
+
+    def scan_transport(self):
+        self.skip_char("{")
+        stop = self.find_char(b"}", "transport region")
+        inner = SexpBufferParser(self.scan_base64_region(stop))
+        self.pos = stop + 1
+        out = inner.scan_object()
+        if out is None:
+            raise IOError("empty transport region at %d" % stop)
+        inner.skip_whitespace()
+        if inner.pos < inner.end:
+            raise IOError("trailing data in transport region at %d" % stop)
+        return out
+
+    def scan_object(self):
+        """Return the next object of any type, or None at EOF.
+
+        Lists are collected on an explicit stack, so deeply nested input does
+        not hit the recursion limit.
+        """
+        buf = self.buf
+        stack = []
+        while True:
+            self.skip_whitespace()
+            if self.pos >= self.end:
+                if stack:
+                    raise ValueError("list is missing closing paren")
+                return None
+            c = buf[self.pos]
+            if c == 0x28:
+                self.pos += 1
+                stack.append([])
+                continue
+            elif c == 0x29:
+                if not stack:
+                    raise ValueError("unbalanced closing paren at %d" % self.pos)
+                self.pos += 1
+                out = stack.pop()
+            elif c == 0x7B:
+                out = self.scan_transport()
+            else:
+                out = self.scan_string()
+            if stack:
+                stack[-1].append(out)
+            else:
+                return out
+
+class SexpDecoder(object):
+    """Incrementally decode S-expressions pushed in arbitrary chunks.
+
+    Data is given to feed() as it arrives (e.g. from a socket or pipe), and
+    completed top-level objects can be taken by iterating over the decoder.
+    Only the object currently being decoded is kept in memory; partially
+    received strings, hex/base64 digits and {...} transport regions carry
+    over between chunks.
+
+    A top-level token or length prefix at the very end of the input is only
+    known to be complete once close() is called.
+
+    If max_length is set, strings longer than that are rejected before they
+    are buffered. After any error the decoder state is undefined.
+    """
+
+    def __init__(self, max_length=None):
+        self.max_length = max_length
+        self.objects = deque()
+        self.stack = []
+        self.state = None
+        self.hint = None
+        self.in_hint = False
+        self.length = None
+        self.out = bytearray()
+        self.digits = b""
+        self.transport = None
+        self.last = 0x0A
+        self.offset = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        if self.objects:
+            return self.objects.popleft()
+        raise StopIteration
+
+    def feed(self, data):
+        data = bytes(data)
+        pos, end = 0, len(data)
+        while pos < end:
+            if self.state is None:
+                pos = self.scan_idle(data, pos)
+            else:
+                pos = getattr(self, "scan_" + self.state)(data, pos)
+        if end:
+            self.last = data[-1]
+            self.offset += end
+
+    def close(self):
+        """Signal end of input, completing any trailing token."""
+        if self.state in ("token", "decimal"):
+            self.scan_delimited(b"", 0)
+        if self.state == "comment":
+            self.state = None
+        if self.state is not None or self.stack or self.in_hint or self.hint:
+            raise ValueError("input ended inside an incomplete object")
+
+    def check_length(self, size):
+        limit = self.length if self.length is not None else self.max_length
+        if limit is not None and size > limit:
+            raise ValueError("string at %d longer than %d bytes" % (
+                self.offset, limit))
+
+    def emit(self, obj):
+        if self.stack:
+            self.stack[-1].append(obj)
+        else:
+            self.objects.append(obj)
+
+    def emit_string(self, value):
+        self.state = None
+        self.length = None
+        self.out = bytearray()
+        if self.in_hint:
+            self.hint = value
+            self.state = "hint_end"
+            return
+        elif self.hint is not None:
+            value = (self.hint, value)
+            self.hint = None
+        self.emit(value)
+
+    def scan_idle(self, data, pos):
+        pos = _WHITESPACE_RE.match(data, pos).end()
+        if pos >= len(data):
+            return pos
+        c = data[pos]
+        prev = data[pos-1] if pos else self.last
+        if c == 0x3B and prev in b"\r\n":
+            self.state = "comment"
+            return pos
+        elif (self.in_hint or self.hint is not None) and c in b"()[{":
+            raise ValueError("hint not followed by a string at %d" % (
+                self.offset + pos))
+        elif c == 0x28:
+            self.stack.append([])
+        elif c == 0x29:
+            if not self.stack:
+                raise ValueError("unbalanced closing paren at %d" % (
+                    self.offset + pos))
+            self.emit(self.stack.pop())
+        elif c == 0x7B:
+            self.state = "transport"
+            self.transport = SexpDecoder(self.max_length)
+        elif c == 0x5B and not self.in_hint:
+            self.in_hint = True
+        elif CHAR_CLASS[c] & CLASS_DIGIT:
+            self.state = "decimal"
+            return pos
+        elif CHAR_CLASS[c] & CLASS_TOKEN:
+            self.state = "token"
+            return pos
+        elif c == 0x22:
+            self.state = "quoted"
+        elif c == 0x23:
+            self.state = "hex"
+        elif c == 0x7C:
+            self.state = "base64"
+        elif c == 0x3A:
+            raise ValueError("verbatim string had no length")
+        else:
+            raise ValueError("illegal char %r at %d" % (chr(c), self.offset + pos))
+        return pos + 1
+
+    def scan_comment(self, data, pos):
+        eol = data.find(b"\n", pos)
+        if eol < 0:
+            return len(data)
+        self.state = None
+        return eol + 1
+
+    def scan_hint_end(self, data, pos):
+        pos = _WHITESPACE_RE.match(data, pos).end()
+        if pos >= len(data):
+            return pos
+        if data[pos] != 0x5D:
+            raise IOError("char %r found where ']' expected at %d" % (
+                chr(data[pos]), self.offset + pos))
+        self.state = None
+        self.in_hint = False
+        return pos + 1
+
+    def scan_token(self, data, pos):
+        return self.scan_delimited(data, pos, _TOKEN_RE)
+
+    def scan_decimal(self, data, pos):
+        return self.scan_delimited(data, pos, _DECIMAL_RE)
+
+    def scan_delimited(self, data, pos, regex=None):
+        if regex:
+            m = regex.match(data, pos)
+            if m:
+                self.out += m.group()
+                pos = m.end()
+                self.check_length(len(self.out))
+            if pos >= len(data):
+                return pos
+        # the token is terminated by data[pos] (or by EOF)
+        if self.state == "token":
+            self.emit_string(bytes(self.out))
+            return pos
+        if len(self.out) > 8:
+            raise IOError("decimal %s... too long" % self.out[:8].decode())
+        self.length = int(self.out)
+        self.out = bytearray()
+        c = data[pos] if pos < len(data) else None
+        if c == 0x3A:
+            self.state = "verbatim"
+        elif c == 0x22:
+            self.state = "quoted"
+        elif c == 0x23:
+            self.state = "hex"
+        elif c == 0x7C:
+            self.state = "base64"
+        else:
+            raise ValueError("length prefix not followed by a string at %d" % (
+                self.offset + pos))
+        if self.max_length is not None and self.length > self.max_length:
+            raise ValueError("string at %d longer than %d bytes" % (
+                self.offset + pos, self.max_length))
+        if self.state == "verbatim" and self.length == 0:
+            self.emit_string(b"")
+        return pos + 1
+
+    def scan_verbatim(self, data, pos):
+        want = self.length - len(self.out)
+        self.out += data[pos:pos+want]
+        pos += want
+        if len(self.out) == self.length:
+            self.emit_string(bytes(self.out))
+        return pos
+
+    def scan_quoted(self, data, pos):
+        m = _QUOTED_RE.match(data, pos)
+        self.out += m.group()
+        pos = m.end()
+        self.check_length(len(self.out))
+        if pos >= len(data):
+            return pos
+        elif data[pos] == 0x22:
+            out = bytes(self.out)
+            if self.length is not None and self.length != len(out):
+                raise ValueError("quoted string length %d != declared length %d" %
+                    (len(out), self.length))
+            self.emit_string(out)
+        else:
+            self.state = "quoted_escape"
+            self.digits = b""
+        return pos + 1
+
+    def scan_quoted_escape(self, data, pos):
+        # self.digits holds the part of the escape sequence seen so far
+        if not self.digits:
+            c = data[pos]
+            self.digits = data[pos:pos+1]
+            pos += 1
+            if c in _QUOTED_ESCAPES:
+                self.out += _QUOTED_ESCAPES[c]
+                self.state = "quoted"
+                self.digits = b""
+            elif c in b"\r\n":
+                self.state = "quoted_newline"
+            elif c not in b"0123x":
+                raise ValueError("unknown escape character \\%s at %d" % (
+                    chr(c), self.offset + pos))
+            return pos
+        want = 3 - len(self.digits)
+        self.digits += data[pos:pos+want]
+        pos += want
+        if len(self.digits) == 3:
+            if self.digits[0] == 0x78:
+                self.out.append(int(self.digits[1:], 16))
+            else:
+                self.out.append(int(self.digits, 8))
+            self.state = "quoted"
+            self.digits = b""
+        return pos
+
+    def scan_quoted_newline(self, data, pos):
+        # skip the second half of a \r\n or \n\r line continuation
+        self.state = "quoted"
+        if data[pos] in b"\r\n" and data[pos] != self.digits[0]:
+            pos += 1
+        self.digits = b""
+        return pos
+
+    def scan_region(self, data, pos, stop_char):
+        stop = data.find(stop_char, pos)
+        chunk = data[pos:] if stop < 0 else data[pos:stop]
+        self.digits += chunk.translate(None, WHITESPACE)
+        return (len(data), False) if stop < 0 else (stop + 1, True)
+
+    def scan_hex(self, data, pos):
+        pos, done = self.scan_region(data, pos, b"#")
+        if done:
+            self.out += _decode_hex(self.digits, self.offset + pos)
+            self.digits = b""
+        else:
+            n = len(self.digits) & ~1
+            self.out += _decode_hex(self.digits[:n], self.offset + pos)
+            self.digits = self.digits[n:]
+        self.check_length(len(self.out))
+        if done:
+            self.finish_region("hexstring")
+        return pos
+
+    def scan_base64(self, data, pos):
+        pos, done = self.scan_region(data, pos, b"|")
+        self.out += self.decode_base64(done, pos)
+        self.check_length(len(self.out))
+        if done:
+            self.finish_region("base64")
+        return pos
+
+    def decode_base64(self, done, pos):
+        if done:
+            n = len(self.digits)
+        else:
+            n = len(self.digits) & ~3
+        out = _decode_base64(self.digits[:n], self.offset + pos)
+        self.digits = self.digits[n:]
+        return out
+
+    def finish_region(self, what):
+        out = bytes(self.out)
+        if self.length is not None and self.length != len(out):
+            raise ValueError("%s length %d != declared length %d" %
+                (what, len(out), self.length))
+        self.emit_string(out)
+
+    def scan_transport(self, data, pos):
+        pos, done = self.scan_region(data, pos, b"}")
+        self.transport.feed(self.decode_base64(done, pos))
+        if done:
+            inner, self.transport = self.transport, None
+            inner.close()
+            objs = list(inner)
+            if len(objs) != 1:
+                raise IOError("transport region ending at %d held %d objects" % (
+                    self.offset + pos, len(objs)))
+            self.state = None
+            self.emit(objs[0])
+        return pos
+
+class SexpView(object):
+    """Lazy, zero-copy view of canonical-encoded S-expressions.
+
+    The view of a whole buffer is a sequence of its top-level objects; the
+    view of a list is a sequence of its elements. Offsets of the elements are
+    only recorded when a list is first accessed, and strings are returned as
+    memoryview slices of the original buffer instead of being copied.
+
+    Indexing with a string looks up the first sub-list starting with that
+    token. If the sub-list is a (key value) pair holding a single string,
+    the value itself is returned, so for a libgcrypt key the modulus is
+    view["private-key"]["rsa"]["n"].
+
+    Display hints are skipped over.
+    """
+
+    def __init__(self, buf, start=0, end=None):
+        self.mv = buf if isinstance(buf, memoryview) else memoryview(buf)
+        self.start = start
+        self.end = len(self.mv) if end is None else end
+        self._children = None
+        self._views = {}
+
+    def scan_string(self, pos):
+        m = _VERBATIM_RE.match(self.mv, pos, self.end)
+        if not m:
+            raise ValueError("canonical string expected at %d" % pos)
+        start = m.end()
+        stop = start + int(m.group(1))
+        if stop > self.end:
+            raise ValueError("string at %d runs past end of list" % pos)
+        return start, stop
+
+    def scan_element(self, pos):
+        """Return (is_list, start, stop, next) for the element at pos."""
+        mv = self.mv
+        c = mv[pos]
+        if c == 0x5B:
+            _, pos = self.scan_string(pos + 1)
+            if pos >= self.end or mv[pos] != 0x5D:
+                raise ValueError("hint at %d is missing closing bracket" % pos)
+            pos += 1
+            start, stop = self.scan_string(pos)
+            return False, start, stop, stop
+        elif c != 0x28:
+            start, stop = self.scan_string(pos)
+            return False, start, stop, stop
+        # skip over the list without recording anything
+        depth, p = 1, pos + 1
+        while depth:
+            if p >= self.end:
+                raise ValueError("list at %d is missing closing paren" % pos)
+            c = mv[p]
+            if c == 0x28:
+                depth += 1
+                p += 1
+            elif c == 0x29:
+                depth -= 1
+                p += 1
+            elif c == 0x5B or c == 0x5D:
+                p += 1
+            else:
+                _, p = self.scan_string(p)
+        return True, pos + 1, p - 1, p
+
+    @property
+    def children(self):
+        if self._children is None:
+            children = []
+            pos = self.start
+            while pos < self.end:
+                is_list, start, stop, pos = self.scan_element(pos)
+                children.append((is_list, start, stop))
+            self._children = children
+        return self._children
+
+    def wrap(self, index):
+        is_list, start, stop = self.children[index]
+        if not is_list:
+            return self.mv[start:stop]
+        # keep the views of sub-lists, so that their elements are only
+        # scanned once
+        view = self._views.get(index)
+        if view is None:
+            view = self._views[index] = SexpView(self.mv, start, stop)
+        return view
+
+    def head_matches(self, start, stop, key):
+        """Check whether the list between start and stop begins with the
+        string key, scanning only its first element."""
+        if start >= stop or self.mv[start] == 0x28:
+            return False
+        _, head_start, head_stop, _ = self.scan_element(start)
+        if head_stop > stop:
+            raise ValueError("string at %d runs past end of list" % start)
+        return self.mv[head_start:head_stop] == key
+
+    def __len__(self):
+        return len(self.children)
+
+    def __iter__(self):
+        for index in range(len(self.children)):
+            yield self.wrap(index)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.wrap(range(len(self.children))[key])
+        if hasattr(key, "encode"):
+            key = key.encode("utf-8")
+        for index, (is_list, start, stop) in enumerate(self.children):
+            if is_list and self.head_matches(start, stop, key):
+                item = self.wrap(index)
+                if len(item) == 2 and not item.children[1][0]:
+                    return item[1]
+                return item
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def load(self):
+        """Fully parse the viewed list into Python objects."""
+        return list(SexpBufferParser(self.mv[self.start:self.end]))
+
+    def __repr__(self):
+        return "<SexpView [%d:%d] of %d bytes>" % (self.start, self.end,
+                                                  len(self.mv))
+
 def load(buf):
-    out = list(SexpParser(buf))
+    out = list(SexpBufferParser(buf))
     if not out:
         return None
     elif len(out) == 1:
@@ -306,25 +1071,178 @@ def load(buf):
     else:
         return out
 
-def dump(obj, canonical=False, transport=False):
-    if transport:
-        canonical = True
-
-    if isinstance(obj, (str, bytes)):
-        exp = dump_string(obj, canonical)
-    elif isinstance(obj, dict):
-        exp = dump_list(obj.items(), canonical)
-    elif isinstance(obj, (list, tuple)):
-        exp = dump_list(obj, canonical)
-    elif isinstance(obj, int):
-        exp = dump_string(str(obj), canonical)
-    else:
-        raise TypeError("unsupported object type %r of %r" % (type(obj), obj))
+class _WriteBuffer(object):
+    """Collect small writes and pass them on to fp in large chunks."""
+
+    def __init__(self, fp, size=65536):
+        self.fp = fp
+        self.size = size
+        self.chunks = []
+        self.length = 0
+
+    def write(self, buf):
+        self.chunks.append(buf)
+        self.length += len(buf)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            self.fp.write(b"".join(self.chunks))
+            self.chunks = []
+            self.length = 0
 
+class _Base64Writer(object):
+    """Base64-encode everything written and pass it on to fp."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.rest = b""
+
+    def write(self, buf):
+        buf = self.rest + buf
+        n = len(buf) - len(buf) % 3
+        self.rest = buf[n:]
+        if n:
+            self.fp.write(base64.b64encode(buf[:n]))
+
+    def flush(self):
+        if self.rest:
+            self.fp.write(base64.b64encode(self.rest))
+            self.rest = b""
+
+def dump_to(obj, fp, canonical=False, transport=False):
+    """Write the S-expression encoding of obj to the writable fp.
+
+    Output is collected in an internal buffer and written in large chunks.
+    Nested lists are walked with an explicit stack, so each string is
+    encoded exactly once no matter how deep it is.
+    """
     if transport:
-        return b"{" + base64.b64encode(exp) + b"}"
-    else:
-        return exp
+        fp.write(b"{")
+        enc = _Base64Writer(fp)
+        dump_to(obj, enc, canonical=True)
+        enc.flush()
+        fp.write(b"}")
+        return
+
+    out = _WriteBuffer(fp)
+    stack = [iter([obj])]
+    need_space = False
+    while stack:
+        for item in stack[-1]:
+            if need_space and not canonical:
+                out.write(b" ")
+            if isinstance(item, int) and not isinstance(item, bool):
+                item = str(item)
+            if isinstance(item, (str, bytes)):
+                if canonical:
+                    if hasattr(item, "encode"):
+                        item = item.encode("utf-8")
+                    out.write(b"%d:" % len(item))
+                    out.write(item)
+                else:
+                    out.write(dump_string(item))
+                need_space = True
+            elif isinstance(item, (dict, list, tuple)):
+                if isinstance(item, dict):
+                    item = item.items()
+                out.write(b"(")
+                stack.append(iter(item))
+                need_space = False
+                break
+            else:
+                raise TypeError("unsupported object type %r of %r" % (
+                    type(item), item))
+        else:
+            stack.pop()
+            if stack:
+                out.write(b")")
+            need_space = True
+    out.flush()
+
+class _HashWriter(object):
+    def __init__(self, hash):
+        self.write = hash.update
+
+def digest(obj, algo="sha256"):
+    """Return the hash of the canonical encoding of obj.
+
+    The encoding is fed to hashlib in chunks as it is produced, without
+    building the whole dump in memory.
+    """
+    h = hashlib.new(algo)
+    dump_to(obj, _HashWriter(h), canonical=True)
+    return h.digest()
+
+class SexpDigestCache(object):
+    """Memoised tree digests for deduplicating S-expressions.
+
+    Each string is hashed once per distinct value, and each list is hashed
+    over the digests of its elements (cached by that sequence), so a
+    sub-expression repeated across many objects (e.g. shared public
+    parameters in a key set) costs only a dict lookup after the first time.
+
+    These tree digests are stable but differ from digest(), which hashes
+    the canonical encoding itself.
+    """
+
+    def __init__(self, algo="sha256"):
+        self.algo = algo
+        self.strings = {}
+        self.lists = {}
+
+    def string_digest(self, buf):
+        if hasattr(buf, "encode"):
+            buf = buf.encode("utf-8")
+        out = self.strings.get(buf)
+        if out is None:
+            out = hashlib.new(self.algo, b"\x00" + buf).digest()
+            self.strings[buf] = out
+        return out
+
+    def digest(self, obj):
+        # walk the tree in post-order with an explicit stack
+        stack = [(obj, None)]
+        results = [[]]
+        while stack:
+            item, children = stack.pop()
+            if children is not None:
+                key = tuple(results.pop())
+                out = self.lists.get(key)
+                if out is None:
+                    out = hashlib.new(self.algo, b"\x01" + b"".join(key)).digest()
+                    self.lists[key] = out
+                results[-1].append(out)
+                continue
+            if isinstance(item, int) and not isinstance(item, bool):
+                item = str(item)
+            if isinstance(item, (str, bytes)):
+                results[-1].append(self.string_digest(item))
+            elif isinstance(item, (dict, list, tuple)):
+                if isinstance(item, dict):
+                    item = item.items()
+                stack.append((item, True))
+                stack.extend((child, None) for child in reversed(list(item)))
+                results.append([])
+            else:
+                raise TypeError("unsupported object type %r of %r" % (
+                    type(item), item))
+        return results[0][0]
+
+    def dedup(self, objs):
+        """Yield the objects, skipping ones equal to an earlier object."""
+        seen = set()
+        for obj in objs:
+            key = self.digest(obj)
+            if key not in seen:
+                seen.add(key)
+                yield obj
+
+def dump(obj, canonical=False, transport=False):
+    buf = BytesIO()
+    dump_to(obj, buf, canonical, transport)
+    return buf.getvalue()
 
 def dump_string(obj, canonical=False, hex=False, hint=None):
     if hasattr(obj, "encode"):
@@ -335,24 +1253,9 @@ def dump_string(obj, canonical=False, hex=False, hint=None):
     elif is_token(obj):
         out = bytes(obj)
     elif is_quoteable(obj):
-        out = bytearray(b'"')
-        # This sucks.
-        # In python2, iterates over 1-char strings.
-        # In python3, iterates over integers. NOT 1-char bytes()
-        # No, screw it. I officially drop Python 2 compatibility here.
-        for char in obj:
-            if char in ESCAPE_CHARS:
-                out += b"\\"
-                out += ESCAPE_CHARS[char]
-            elif char in b"'\"":
-                out += b"\\"
-                out.append(char)
-            else:
-                out.append(char)
-        out += b'"'
-        out = bytes(out)
+        out = b'"' + _QUOTE_RE.sub(_quote_char, obj) + b'"'
     elif hex:
-        out = b"#" + obj.encode("hex") + b"#"
+        out = b"#" + obj.hex().encode() + b"#"
     else:
         out = b"|" + base64.b64encode(obj) + b"|"
 
@@ -366,13 +1269,7 @@ def dump_hint(obj, canonical=False):
     return b"[" + dump_string(obj, canonical) + b"]"
 
 def dump_list(obj, canonical=False):
-    out = b"("
-    if canonical:
-        out += b"".join(dump(x, canonical=True) for x in obj)
-    else:
-        out += b" ".join(dump(x) for x in obj)
-    out += b")"
-    return out
+    return dump(list(obj), canonical)
 
 def to_int(buf):
     num = 0
@@ -382,21 +1279,9 @@ def to_int(buf):
     return num
 
 def is_token(string):
-    if string[0] in DIGITS:
+    if not string or string[0] in DIGITS:
         return False
-    for char in string:
-        if char not in TOKEN_CHARS:
-            return False
-    return True
+    return _TOKEN_RE.fullmatch(string) is not None
 
 def is_quoteable(string):
-    for char in string:
-        if char in VERBATIM:
-            return False
-        elif char in PRINTABLE_CHARS:
-            pass
-        elif char in ESCAPE_CHARS:
-            pass
-        else:
-            return False
-    return True
+    return not string.translate(None, QUOTEABLE_CHARS)
@@ -0,0 +1,346 @@
+# Benchmark, round-trip check and fuzzer for nullroute.sexp
+#
+# Usage: python3 -m nullroute.sexp_bench [-n KEYS] [-r ROUNDS] [-s SEED]
+#                                         [--compare | --micro | --fuzz N]
+#
+# The default run generates a set of corpora (RSA and ECC keys, deeply nested
+# lists, large binary blobs), encodes each in advanced, canonical and
+# transport form, reports parse/dump throughput and peak memory, and checks
+# that everything round-trips through load() and dump().
+
+import argparse
+import base64
+import random
+import sys
+import time
+import tracemalloc
+
+from nullroute import sexp
+
+def make_key(rng, bits=2048):
+    """Return a fake RSA private key in advanced (human-readable) form."""
+    nbytes = bits // 8
+    parts = []
+    for name, size in [("n", nbytes), ("e", 3), ("d", nbytes),
+                       ("p", nbytes // 2), ("q", nbytes // 2),
+                       ("u", nbytes // 2)]:
+        value = rng.randbytes(size)
+        if name in "nd":
+            parts.append(b"(%s #%s#)" % (name.encode(), value.hex().encode()))
+        else:
+            parts.append(b"(%s |%s|)" % (name.encode(), base64.b64encode(value)))
+    return b"(private-key (rsa %s) (comment \"benchmark key\"))\n" % \
+           b" ".join(parts)
+
+def make_rsa_keys(rng, count, bits=2048):
+    nbytes = bits // 8
+    keys = []
+    for i in range(count):
+        params = [[name, b"\x00" + rng.randbytes(size)]
+                  for name, size in [(b"n", nbytes), (b"e", 2),
+                                     (b"d", nbytes), (b"p", nbytes // 2),
+                                     (b"q", nbytes // 2), (b"u", nbytes // 2)]]
+        keys.append([b"private-key", [b"rsa"] + params])
+    return keys
+
+def make_ecc_keys(rng, count):
+    keys = []
+    for i in range(count):
+        keys.append([b"private-key",
+                     [b"ecc",
+                      [b"curve", b"Ed25519"],
+                      [b"flags", b"eddsa"],
+                      [b"q", b"\x40" + rng.randbytes(32)],
+                      [b"d", rng.randbytes(32)]],
+                     [b"comment", b"key %d from the benchmark corpus" % i]])
+    return keys
+
+def make_deep_lists(rng, count, depth=5000):
+    objs = []
+    for i in range(count):
+        obj = [b"leaf", rng.randbytes(8)]
+        for j in range(depth):
+            obj = [b"level", obj] if j % 2 else [obj]
+        objs.append(obj)
+    return objs
+
+def make_blobs(rng, count, size=1 << 20):
+    return [[b"blob", b"application/octet-stream", rng.randbytes(size)]
+            for i in range(count)]
+
+# values written as quoted strings with escapes in advanced form
+ESCAPED_VALUES = [b"a\nb", b'x"y', b"\x00\x7f", b"tab\there", b"back\\slash",
+                  b"it's", b"cr\r\nlf", b"a b"]
+
+def make_escaped(rng, count):
+    # mixed with binary values, which are written as hex or base64
+    objs = []
+    for i in range(count):
+        items = []
+        for value in rng.sample(ESCAPED_VALUES, 4):
+            items += [value, rng.randbytes(rng.randint(1, 12))]
+        objs.append([b"escaped", items, [b"tail", rng.choice(ESCAPED_VALUES)]])
+    return objs
+
+def make_corpora(rng, nkeys):
+    return {
+        "rsa":      make_rsa_keys(rng, nkeys),
+        "ecc":      make_ecc_keys(rng, nkeys * 4),
+        "escaped":  make_escaped(rng, nkeys * 4),
+        "deep":     make_deep_lists(rng, max(1, nkeys // 50)),
+        "blobs":    make_blobs(rng, max(1, nkeys // 50)),
+    }
+
+FORMS = {
+    "advanced":     {},
+    "canonical":    {"canonical": True},
+    "transport":    {"transport": True},
+}
+
+def encode_corpus(objs, form):
+    sep = b"" if form == "canonical" else b"\n"
+    return sep.join(sexp.dump(obj, **FORMS[form]) for obj in objs)
+
+# string encodings for the per-encoding micro-benchmark
+ENCODINGS = {
+    "token":    lambda value: value.hex().encode(),
+    "quoted":   lambda value: b'"%s"' % value.hex().encode(),
+    "hex":      lambda value: b"#%s#" % value.hex().encode(),
+    "base64":   lambda value: b"|%s|" % base64.b64encode(value),
+    "verbatim": lambda value: b"%d:%s" % (len(value), value),
+}
+
+def make_string_corpus(rng, encoding, count, size=64):
+    encode = ENCODINGS[encoding]
+    # tokens may not start with a digit
+    items = [b"(x " + (b"t" if encoding == "token" else b"") +
+             encode(rng.randbytes(size)) + b")\n" for i in range(count)]
+    return b"".join(items)
+
+def bench(name, func, data, rounds, size=None, memory=False):
+    best = None
+    for i in range(rounds):
+        t = time.perf_counter()
+        result = func(data)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    size = len(data) if size is None else size
+    line = "%-24s %8.3f s %10.2f MB/s" % (name, best, size / best / 1e6)
+    if memory:
+        tracemalloc.start()
+        func(data)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        line += " %10.1f MB peak" % (peak / 1e6)
+    print(line)
+    return result
+
+def decode_chunked(data, size=4096):
+    dec = sexp.SexpDecoder()
+    out = []
+    for i in range(0, len(data), size):
+        dec.feed(data[i:i+size])
+        out += dec
+    dec.close()
+    out += dec
+    return out
+
+def same(a, b):
+    # digest() walks the objects iteratively, unlike == on deeply nested lists
+    return len(a) == len(b) and \
+           all(sexp.digest(x) == sexp.digest(y) for x, y in zip(a, b))
+
+# inputs which once broke SexpDecoder; each is decoded in every chunk size
+REGRESSIONS = [
+    # escape sequence state leaking into the following region
+    b'("a\\nb" #6162#)',
+    b'("a\\nb" |YWJj|)',
+    b'("a\\x41" {KDE6YWIp})',
+    b'("a\\101\\\r\nc" #61 62# "\\"" |YQ|)',
+]
+
+def check_regressions():
+    failed = 0
+    for data in REGRESSIONS:
+        want = list(sexp.SexpBufferParser(data))
+        for size in range(1, len(data) + 1):
+            try:
+                got = decode_chunked(data, size)
+            except (IOError, ValueError) as e:
+                got = e
+            if got != want:
+                print("FAIL: SexpDecoder returned %r for %r in %d-byte chunks"
+                      % (got, data, size))
+                failed += 1
+                break
+    return failed
+
+def check_form(objs, form, data, args):
+    failed = 0
+    parsed = bench("parse", lambda buf: list(sexp.SexpBufferParser(buf)),
+                   data, args.rounds, memory=True)
+    decoded = bench("decode (4k chunks)", decode_chunked,
+                    data, args.rounds, memory=True)
+    dumped = bench("dump", lambda objs: encode_corpus(objs, form),
+                   parsed, args.rounds, size=len(data), memory=True)
+    if form == "canonical":
+        view = sexp.SexpView(data)
+        if len(view) != len(objs):
+            print("FAIL: SexpView found %d objects" % len(view))
+            failed += 1
+    for what, result in [("load", parsed), ("SexpDecoder", decoded)]:
+        if not same(result, objs):
+            print("FAIL: %s did not return the original objects" % what)
+            failed += 1
+    if dumped != data:
+        print("FAIL: dump did not reproduce the input")
+        failed += 1
+    return failed
+
+def run_suite(args, rng):
+    failed = check_regressions()
+    for name, objs in make_corpora(rng, args.keys).items():
+        for form in FORMS:
+            data = encode_corpus(objs, form)
+            print("== %s/%s: %d objects, %d bytes" % (name, form, len(objs),
+                                                       len(data)))
+            try:
+                failed += check_form(objs, form, data, args)
+            except (IOError, ValueError) as e:
+                print("FAIL: could not parse the %s form: %s" % (form, e))
+                failed += 1
+    print("Total: %d failed" % failed)
+    return failed
+
+def run_compare(args, rng):
+    data = b"".join(make_key(rng) for i in range(args.keys))
+    print("corpus: %d keys, %d bytes" % (args.keys, len(data)))
+    old = bench("SexpParser", lambda buf: list(sexp.SexpParser(buf)),
+                data, args.rounds)
+    new = bench("SexpBufferParser", lambda buf: list(sexp.SexpBufferParser(buf)),
+                data, args.rounds)
+    if old != new:
+        print("FAIL: parsers returned different results")
+        return 1
+    return 0
+
+def run_micro(args, rng):
+    for encoding in ENCODINGS:
+        data = make_string_corpus(rng, encoding, args.keys * 20)
+        for cls in (sexp.SexpParser, sexp.SexpBufferParser):
+            bench("%s %s" % (encoding, cls.__name__[4:]),
+                  lambda buf: list(cls(buf)), data, args.rounds)
+    return 0
+
+def mutate(rng, data):
+    data = bytearray(data)
+    for i in range(rng.randint(1, 4)):
+        pos = rng.randrange(len(data) + 1)
+        op = rng.randrange(4)
+        if op == 0 and pos < len(data):
+            data[pos] = rng.randrange(256)
+        elif op == 1:
+            data[pos:pos] = rng.choice([b"(", b")", b"{", b"}", b"#", b"|",
+                                        b"\"", b"\\", b"[", b"]", b"9:",
+                                        b";", b"\n"])
+        elif op == 2:
+            del data[pos:pos + rng.randint(1, 8)]
+        else:
+            del data[pos:]
+    return bytes(data)
+
+def strip_hints(obj):
+    if isinstance(obj, tuple):
+        return obj[1]
+    elif isinstance(obj, list):
+        return [strip_hints(item) for item in obj]
+    return obj
+
+def view_objects(view):
+    # walk the view itself, which (unlike load()) drops display hints
+    return [view_objects(item) if isinstance(item, sexp.SexpView)
+            else bytes(item) for item in view]
+
+def canonical_objects(buf, objs):
+    # SexpView only reads canonical input
+    if b"".join(sexp.dump(obj, canonical=True) for obj in objs) == buf:
+        return strip_hints(objs)
+    return None
+
+def run_fuzz(args, rng):
+    seeds = []
+    for obj in make_rsa_keys(rng, 2, 512) + make_ecc_keys(rng, 2) + \
+               make_escaped(rng, 4) + \
+               [[b"a", [b"b c", b"\n"], [b"", [[b"x\x00"]]]]]:
+        seeds += [sexp.dump(obj, **kw) for kw in FORMS.values()]
+    seeds.append(make_key(rng, 512))
+
+    # SexpBufferParser is the reference: whatever it accepts, SexpDecoder
+    # (in random chunk sizes) and, for canonical input, SexpView must
+    # accept as well and return the same objects for
+    others = [
+        ("SexpDecoder", lambda buf: decode_chunked(buf, rng.randint(1, 64)),
+         lambda buf, objs: objs),
+        ("SexpView", lambda buf: view_objects(sexp.SexpView(buf)),
+         canonical_objects),
+    ]
+    failed = 0
+    for i in range(args.fuzz):
+        data = mutate(rng, rng.choice(seeds))
+        try:
+            want = list(sexp.SexpBufferParser(data))
+        except (IOError, ValueError):
+            want = None
+        except Exception as e:
+            print("FAIL: SexpBufferParser raised %r on %r" % (e, data))
+            failed += 1
+            continue
+        for name, func, expect in others:
+            expected = expect(data, want) if want is not None else None
+            try:
+                got = func(data)
+            except (IOError, ValueError) as e:
+                if expected is not None:
+                    print("FAIL: %s rejected %r (%s)" % (name, data, e))
+                    failed += 1
+                continue
+            except Exception as e:
+                print("FAIL: %s raised %r on %r" % (name, e, data))
+                failed += 1
+                continue
+            if expected is not None and got != expected:
+                print("FAIL: %s returned %r instead of %r for %r" % (
+                      name, got, expected, data))
+                failed += 1
+    print("Fuzz: %d inputs, %d failed" % (args.fuzz, failed))
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--keys", type=int, default=200,
+                        help="number of keys in the generated corpora")
+    parser.add_argument("-r", "--rounds", type=int, default=3,
+                        help="number of rounds (best one is reported)")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="random seed for the generated corpora")
+    parser.add_argument("--compare", action="store_true",
+                        help="compare SexpParser with SexpBufferParser")
+    parser.add_argument("-m", "--micro", action="store_true",
+                        help="benchmark each string encoding separately")
+    parser.add_argument("--fuzz", type=int, metavar="N",
+                        help="parse N randomly mutated inputs")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.compare:
+        failed = run_compare(args, rng)
+    elif args.micro:
+        failed = run_micro(args, rng)
+    elif args.fuzz:
+        failed = run_fuzz(args, rng)
+    else:
+        failed = run_suite(args, rng)
+    sys.exit(failed > 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+# Inventory of S-expression keystores (gpg-agent private-keys-v1.d, OTR)
+#
+# Usage: python3 -m nullroute.sexp_keyscan [-j JOBS] [--index FILE] DIR...
+#
+# Files are parsed in a process pool and the extracted metadata is kept in a
+# JSON index keyed by (path, mtime, size), so that repeated scans only parse
+# the files that have changed.
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import re
+import sys
+
+from nullroute import sexp
+
+KEY_TYPES = {b"private-key", b"protected-private-key",
+             b"shadowed-private-key", b"public-key"}
+
+# parameter holding the "size" of the key for each algorithm
+SIZE_PARAMS = {b"rsa": b"n", b"dsa": b"p", b"elg": b"p"}
+
+KEYGRIP_RE = re.compile(r"^[0-9A-F]{40}$")
+
+def default_index_path():
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or \
+                os.path.expanduser("~/.cache")
+    return os.path.join(cache_dir, "nullroute", "sexp-keyscan.json")
+
+def read_key_file(path):
+    """Read a key file, unwrapping the 'Key:' field of gpg-agent's extended
+    (name-value) key format if present."""
+    with open(path, "rb") as fh:
+        data = fh.read()
+    if data.lstrip()[:1] in (b"(", b"{", b""):
+        return data
+    key, in_key = [], False
+    for line in data.splitlines():
+        if line[:1] in (b" ", b"\t"):
+            if in_key:
+                key.append(line)
+        else:
+            in_key = line.startswith(b"Key:")
+            if in_key:
+                key.append(line[4:])
+    return b"\n".join(key)
+
+def _params(items):
+    params = {}
+    for item in items:
+        if isinstance(item, list) and len(item) >= 2 \
+                and isinstance(item[0], bytes) and isinstance(item[1], bytes):
+            params.setdefault(item[0], item[1])
+    return params
+
+def describe_key(obj, path):
+    """Return metadata of a (private-key (algo ...)) list."""
+    kind = obj[0].decode()
+    algo = obj[1] if len(obj) > 1 and isinstance(obj[1], list) else []
+    name = algo[0] if algo and isinstance(algo[0], bytes) else b""
+    params = _params(algo[1:])
+    info = {"kind": kind,
+            "algo": name.decode("utf-8", "replace"),
+            "bits": None,
+            "curve": None,
+            "keygrip": None}
+    if name in SIZE_PARAMS and SIZE_PARAMS[name] in params:
+        info["bits"] = int.from_bytes(params[SIZE_PARAMS[name]], "big").bit_length()
+    if b"curve" in params:
+        info["curve"] = params[b"curve"].decode("utf-8", "replace")
+    if name == b"rsa" and b"n" in params:
+        # libgcrypt hashes the modulus exactly as stored
+        info["keygrip"] = hashlib.sha1(params[b"n"]).hexdigest().upper()
+    else:
+        # gpg-agent names key files after their keygrip
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if KEYGRIP_RE.match(stem):
+            info["keygrip"] = stem
+    return info
+
+def find_keys(obj, path, account=None):
+    """Walk a parsed object and describe every key found in it."""
+    found = []
+    stack = [(obj, account)]
+    while stack:
+        obj, account = stack.pop()
+        if not isinstance(obj, list) or not obj:
+            continue
+        head = obj[0] if isinstance(obj[0], bytes) else None
+        if head in KEY_TYPES:
+            info = describe_key(obj, path)
+            if account:
+                info["account"] = account
+            found.append(info)
+            continue
+        if head == b"account":
+            # OTR keystore: (account (name "...") (protocol ...) (private-key ...))
+            params = _params(obj[1:])
+            account = "%s/%s" % (
+                params.get(b"protocol", b"").decode("utf-8", "replace"),
+                params.get(b"name", b"").decode("utf-8", "replace"))
+        for item in reversed(obj):
+            stack.append((item, account))
+    return found
+
+def scan_file(path):
+    """Parse one key file; return (path, keys, error)."""
+    try:
+        objs = list(sexp.SexpBufferParser(read_key_file(path)))
+        keys = []
+        for obj in objs:
+            keys += find_keys(obj, path)
+        return path, keys, None
+    except (IOError, ValueError) as e:
+        return path, [], str(e)
+    except Exception as e:
+        # a malformed file must not abort the whole scan
+        return path, [], "%s: %s" % (type(e).__name__, e)
+
+class KeyIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(path, "r") as fh:
+                self.entries = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            # corrupt index, start over
+            self.dirty = True
+
+    def lookup(self, path, st):
+        entry = self.entries.get(path)
+        if entry and entry["mtime"] == st.st_mtime_ns \
+                 and entry["size"] == st.st_size:
+            return entry
+        return None
+
+    def update(self, path, st, keys, error=None):
+        self.entries[path] = {"mtime": st.st_mtime_ns,
+                              "size": st.st_size,
+                              "keys": keys,
+                              "error": error}
+        self.dirty = True
+
+    def prune(self, top, seen):
+        """Forget files under top which no longer exist."""
+        top = os.path.join(top, "")
+        for path in list(self.entries):
+            if path.startswith(top) and path not in seen:
+                del self.entries[path]
+                self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(self.entries, fh)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+def walk_keystore(top):
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith((".key", ".private_key", ".privkey", ".pub")) \
+                    or name in ("otr.private_key", "identity"):
+                yield os.path.join(dirpath, name)
+
+def scan_keystore(dirs, index_path=None, jobs=None):
+    """Scan the given keystore directories.
+
+    Only files whose mtime or size changed since the last scan are parsed.
+    Returns ({path: entry}, number of files parsed).
+    """
+    index = KeyIndex(index_path or default_index_path())
+    stats = {}
+    todo = []
+    for top in dirs:
+        for path in walk_keystore(os.path.abspath(top)):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = st
+            if not index.lookup(path, st):
+                todo.append(path)
+
+    if jobs == 1 or len(todo) <= 1:
+        for path, keys, error in map(scan_file, todo):
+            index.update(path, stats[path], keys, error)
+    else:
+        chunksize = max(1, len(todo) // ((jobs or os.cpu_count() or 1) * 4))
+        with ProcessPoolExecutor(jobs) as pool:
+            for path, keys, error in pool.map(scan_file, todo,
+                                              chunksize=chunksize):
+                index.update(path, stats[path], keys, error)
+
+    for top in dirs:
+        index.prune(os.path.abspath(top), stats)
+    index.save()
+    return {path: index.entries[path] for path in stats}, len(todo)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dirs", nargs="+",
+                        help="keystore directories to scan")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="number of worker processes")
+    parser.add_argument("--index",
+                        help="path to the index file")
+    parser.add_argument("--json", action="store_true",
+                        help="output JSON lines instead of a table")
+    args = parser.parse_args()
+
+    entries, parsed = scan_keystore(args.dirs, args.index, args.jobs)
+    for path, entry in sorted(entries.items()):
+        if entry["error"]:
+            print("%s: error: %s" % (path, entry["error"]), file=sys.stderr)
+        for key in entry["keys"]:
+            if args.json:
+                print(json.dumps(dict(key, path=path)))
+            else:
+                print("%-40s %-22s %-6s %-10s %s" % (
+                    key["keygrip"] or "-",
+                    key["kind"],
+                    key["algo"],
+                    key["bits"] or key["curve"] or "-",
+                    key.get("account") or path))
+    print("%d files, %d parsed" % (len(entries), parsed), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()